@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import re
+import io
+import csv
+import json
+import time
+import threading
+from six.moves import socketserver
+from six.moves import BaseHTTPServer
+from six.moves.urllib.parse import urlparse, parse_qs, urlencode
+
+
+# Module API
+
+class FakeCkan(object):
+    """In-process stand-in for the CKAN DataStore action API
+
+    It implements the actions used by `Storage` on tables kept in memory:
+    `package_show`, `datastore_create`, `datastore_delete`,
+    `datastore_upsert`, `datastore_search` (including `_table_metadata`),
+    the `datastore_search_sql` queries of keyset paging and the CSV
+    `/datastore/dump` endpoint.
+
+    ```python
+    with FakeCkan(latency=0.01) as ckan:
+        storage = Storage(ckan.base_url, dataset_id=ckan.dataset_id)
+    ```
+
+    # Arguments
+        latency (float):
+            seconds every request is delayed by.
+        page_size (int):
+            default `datastore_search` limit.
+        dataset_id (str):
+            name of the only dataset, holding every table as a resource.
+
+    """
+
+    # Public
+
+    def __init__(self, latency=0, page_size=100, dataset_id='dataset'):
+        self.latency = latency
+        self.page_size = page_size
+        self.dataset_id = dataset_id
+        self.tables = {}
+        self.requests = 0
+        self.__lock = threading.Lock()
+        self.__server = _Server(('127.0.0.1', 0), _Handler)
+        self.__server.ckan = self
+        self.__thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @property
+    def base_url(self):
+        host, port = self.__server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__server.serve_forever)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+        self.__thread.join()
+
+    def add_table(self, name, fields, records=(), primary_key=None):
+        '''Create a table from DataStore `fields` with JSON `records`.
+        '''
+        table = _Table(fields, primary_key)
+        table.upsert(records, 'insert')
+        with self.__lock:
+            self.tables[name] = table
+
+    # Actions
+
+    def package_show(self, params):
+        resources = [{'id': name, 'datastore_active': True}
+                     for name in sorted(self.tables)]
+        return {'id': self.dataset_id, 'resources': resources}
+
+    def datastore_create(self, params):
+        table = _Table(params['fields'], params.get('primary_key'))
+        with self.__lock:
+            self.tables[params['resource_id']] = table
+        return {'resource_id': params['resource_id']}
+
+    def datastore_delete(self, params):
+        with self.__lock:
+            del self.tables[params['resource_id']]
+        return {'resource_id': params['resource_id']}
+
+    def datastore_upsert(self, params):
+        table = self.tables[params['resource_id']]
+        table.upsert(params['records'], params.get('method', 'upsert'))
+        return {'resource_id': params['resource_id'],
+                'method': params.get('method', 'upsert')}
+
+    def datastore_search(self, params):
+        resource_id = params['resource_id']
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', self.page_size))
+        filters = json.loads(params.get('filters', '{}'))
+        if resource_id == '_table_metadata':
+            fields = [{'id': '_id', 'type': 'int'},
+                      {'id': 'name', 'type': 'text'}]
+            records = [{'_id': i + 1, 'name': name}
+                       for i, name in enumerate(sorted(self.tables))]
+        else:
+            table = self.tables[resource_id]
+            fields = table.fields
+            records = table.records
+        for name, value in filters.items():
+            values = value if isinstance(value, list) else [value]
+            records = [r for r in records if r.get(name) in values]
+        if 'fields' in params:
+            names = params['fields'].split(',')
+            fields = [f for f in fields if f['id'] in names]
+            records = [{n: r[n] for n in names} for r in records]
+        next_params = dict(params, offset=offset + limit)
+        return {
+            'resource_id': resource_id,
+            'fields': fields,
+            'records': records[offset:offset + limit],
+            'total': len(records),
+            '_links': {
+                'next': '/api/3/action/datastore_search?' +
+                urlencode(sorted(next_params.items()))
+            },
+        }
+
+    def datastore_search_sql(self, params):
+        match = _KEYSET_SQL.match(params['sql'])
+        if match is None:
+            raise ValueError('Unsupported SQL: {}'.format(params['sql']))
+        table = self.tables[match.group('table')]
+        names = [n.strip().strip('"') for n in match.group('columns').split(',')]
+        start = 0
+        if match.group('last') is not None:
+            start = int(match.group('last'))
+        limit = int(match.group('limit'))
+        # Records are ordered by _id, which starts at 1
+        records = table.records[start:start + limit]
+        return {'records': [{n: r[n] for n in names} for r in records]}
+
+    def dump(self, resource_id):
+        table = self.tables[resource_id]
+        names = [f['id'] for f in table.fields]
+        stream = io.StringIO()
+        writer = csv.writer(stream)
+        writer.writerow(names)
+        for record in table.records:
+            writer.writerow([_to_csv(record[n]) for n in names])
+        return stream.getvalue().encode('utf-8')
+
+    # Private
+
+    def _handle(self, handler):
+        time.sleep(self.latency)
+        with self.__lock:
+            self.requests += 1
+        url = urlparse(handler.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if handler.command == 'POST':
+            length = int(handler.headers.get('Content-Length', 0))
+            params.update(json.loads(handler.rfile.read(length)))
+        if url.path.startswith('/datastore/dump/'):
+            return 200, 'text/csv', self.dump(url.path.split('/')[-1])
+        action = getattr(self, url.path.split('/')[-1], None)
+        try:
+            result = action(params)
+            body = {'success': True, 'result': result}
+            status = 200
+        except Exception as exception:
+            body = {'success': False, 'error': {'message': repr(exception)}}
+            status = 409
+        return status, 'application/json', json.dumps(body).encode('utf-8')
+
+
+# Internal
+
+_KEYSET_SQL = re.compile(
+    r'^SELECT (?P<columns>.+?) FROM "(?P<table>[^"]+)"'
+    r'(?: WHERE \("_id"\) > \((?P<last>\d+)\))?'
+    r' ORDER BY "_id" LIMIT (?P<limit>\d+)$')
+
+
+class _Table(object):
+
+    def __init__(self, fields, primary_key=None):
+        self.fields = [{'id': '_id', 'type': 'int'}] + list(fields)
+        if isinstance(primary_key, (list, tuple)):
+            primary_key = primary_key[0] if primary_key else None
+        self.primary_key = primary_key
+        self.records = []
+        self.index = {}
+        self.lock = threading.Lock()
+        self.casts = {f['id']: _CASTS.get(f.get('type'), _identity)
+                      for f in fields}
+
+    def upsert(self, records, method):
+        with self.lock:
+            for record in records:
+                record = {k: self.casts.get(k, _identity)(v)
+                          for k, v in record.items()}
+                key = record.get(self.primary_key)
+                if method != 'insert' and key in self.index:
+                    self.records[self.index[key]].update(record)
+                    continue
+                record['_id'] = len(self.records) + 1
+                for field in self.fields:
+                    record.setdefault(field['id'], None)
+                if self.primary_key is not None:
+                    self.index[key] = len(self.records)
+                self.records.append(record)
+
+
+def _identity(value):
+    return value
+
+
+def _cast(type):
+    def cast(value):
+        if value is None or value == '':
+            return None
+        if type is bool and not isinstance(value, bool):
+            return value in ['true', 'True', '1']
+        return type(value)
+    return cast
+
+
+def _to_csv(value):
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+
+_CASTS = {
+    'int': _cast(int),
+    'float': _cast(float),
+    'bool': _cast(bool),
+}
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        status, content_type, body = self.server.ckan._handle(self)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
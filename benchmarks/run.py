@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the storage against a local fake CKAN DataStore
+
+    python -m benchmarks.run --rows 10000,1000000 --columns 4,16 \\
+        --latency 0.005 --output benchmarks/results/latest.json \\
+        --baseline benchmarks/results/previous.json
+
+Each benchmark records its duration and throughput in rows per second. With
+`--baseline`, results more than `--tolerance` slower than the baseline are
+reported and the script exits with status 1.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import datetime
+import collections
+import tableschema
+from tableschema_ckan_datastore import Storage, __version__
+from tableschema_ckan_datastore import columnar
+from tableschema_ckan_datastore.mapper import Mapper
+from .ckan import FakeCkan
+
+
+# Module API
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', default='10000',
+                        help='comma separated numbers of rows')
+    parser.add_argument('--columns', default='4,16',
+                        help='comma separated numbers of columns')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every request')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='default datastore_search limit of the server')
+    parser.add_argument('--buckets', type=int, default=1000,
+                        help='number of tables listed by Storage.buckets')
+    parser.add_argument('--output', help='path of the results JSON file')
+    parser.add_argument('--baseline', help='path of results to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='accepted slowdown relative to the baseline')
+    args = parser.parse_args(argv)
+
+    results = []
+    for columns in _parse_list(args.columns):
+        for rows in _parse_list(args.rows):
+            results.extend(bench_table(rows, columns, args.latency,
+                                       args.page_size))
+    results.extend(bench_buckets(args.buckets, args.latency, args.page_size))
+
+    report = {
+        'created': datetime.datetime.utcnow().isoformat(),
+        'version': __version__,
+        'python': platform.python_version(),
+        'latency': args.latency,
+        'page_size': args.page_size,
+        'results': results,
+    }
+    if args.output:
+        with io.open(args.output, 'w', encoding='utf-8') as file:
+            file.write(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with io.open(args.baseline, encoding='utf-8') as file:
+            baseline = json.load(file)
+        regressions = compare(baseline['results'], results, args.tolerance)
+        for name, before, after in regressions:
+            print('REGRESSION {}: {:.0f} -> {:.0f} rows/s'.format(
+                name, before, after))
+        if regressions:
+            return 1
+    return 0
+
+
+def bench_table(rows, columns, latency, page_size):
+    '''Return the results of the Mapper, write and read benchmarks.
+    '''
+    descriptor = make_descriptor(columns)
+    schema = tableschema.Schema(descriptor)
+    data = [make_row(i, columns) for i in range(rows)]
+    results = []
+
+    def record(name, seconds, count=rows):
+        results.append(_result(name, rows, columns, seconds, count))
+
+    # Mapper
+    mapper = Mapper()
+    convert_row = mapper.compile_convert_row(schema)
+    records, seconds = _timed(lambda: [convert_row(row) for row in data])
+    record('mapper.convert_row', seconds)
+    with FakeCkan(page_size=page_size) as ckan:
+        ckan.add_table('table', mapper.descriptor_to_datastore_dict(
+            descriptor, 'table')['fields'], records, primary_key='id')
+        response = ckan.datastore_search({'resource_id': 'table',
+                                          'limit': rows})
+    restore_row = mapper.compile_restore_row(schema)
+    _, seconds = _timed(
+        lambda: [restore_row(r) for r in response['records']])
+    record('mapper.restore_row', seconds)
+
+    with FakeCkan(latency=latency, page_size=page_size) as ckan:
+        storage = Storage(ckan.base_url, dataset_id=ckan.dataset_id)
+
+        # Write
+        for name, options in WRITE_OPTIONS:
+            storage.create('table', descriptor, force=True)
+            _, seconds = _timed(
+                lambda: storage.write('table', iter(data), **options))
+            record('storage.write[{}]'.format(name), seconds)
+        column_data = dict(zip([f['name'] for f in descriptor['fields']],
+                               [list(column) for column in zip(*data)]))
+        for format in BATCH_FORMATS:
+            if _is_available(format):
+                storage.create('table', descriptor, force=True)
+                _, seconds = _timed(lambda: storage.write_batches(
+                    'table', _make_columns(column_data, format)))
+                record('storage.write_batches[{}]'.format(format), seconds)
+
+        # Read
+        for name, options in READ_OPTIONS:
+            count, seconds = _timed(
+                lambda: sum(1 for _ in storage.iter('table', **options)))
+            record('storage.iter[{}]'.format(name), seconds, count)
+        for format in BATCH_FORMATS:
+            if _is_available(format):
+                _, seconds = _timed(lambda: storage.read_columnar(
+                    'table', format=format, paging='keyset',
+                    page_size=10000))
+                record('storage.read_columnar[{}]'.format(format), seconds)
+
+    return results
+
+
+def bench_buckets(buckets, latency, page_size):
+    '''Return the results of listing `buckets` tables.
+    '''
+    with FakeCkan(latency=latency, page_size=page_size) as ckan:
+        for i in range(buckets):
+            ckan.add_table('table-{}'.format(i), [])
+        storage = Storage(ckan.base_url)
+        count, seconds = _timed(lambda: len(storage.buckets))
+    return [_result('storage.buckets', buckets, 0, seconds, count)]
+
+
+def compare(baseline, results, tolerance):
+    '''Return `(name, before, after)` throughputs which regressed.
+    '''
+    before = {_key(r): r['rows_per_second'] for r in baseline}
+    regressions = []
+    for result in results:
+        previous = before.get(_key(result))
+        if previous and \
+                result['rows_per_second'] < previous * (1 - tolerance):
+            regressions.append(
+                (_key(result), previous, result['rows_per_second']))
+    return regressions
+
+
+def make_descriptor(columns):
+    '''Return a descriptor with an `id` primary key and `columns` fields.
+    '''
+    fields = [{'name': 'id', 'type': 'integer'}]
+    for i in range(1, columns):
+        type = COLUMN_TYPES[i % len(COLUMN_TYPES)][0]
+        fields.append({'name': 'column_{}'.format(i), 'type': type})
+    return {'fields': fields, 'primaryKey': 'id'}
+
+
+def make_row(index, columns):
+    '''Return a row of strings, as read from CSV, matching the descriptor.
+    '''
+    row = [str(index)]
+    for i in range(1, columns):
+        row.append(COLUMN_TYPES[i % len(COLUMN_TYPES)][1](index))
+    return row
+
+
+# Internal
+
+COLUMN_TYPES = [
+    ('string', lambda i: 'value {}'.format(i)),
+    ('integer', lambda i: str(i * 7)),
+    ('number', lambda i: '{}.5'.format(i)),
+    ('boolean', lambda i: 'true' if i % 2 else 'false'),
+    ('date', lambda i: '2020-01-{:02d}'.format(i % 28 + 1)),
+    ('datetime', lambda i: '2020-01-01T00:{:02d}:00'.format(i % 60)),
+    ('object', lambda i: '{"index": %d}' % i),
+]
+
+WRITE_OPTIONS = [
+    ('batch', {}),
+    ('workers=4', {'workers': 4}),
+]
+
+READ_OPTIONS = [
+    ('offset', {}),
+    ('offset,page_size=10000', {'page_size': 10000}),
+    ('keyset,page_size=10000', {'paging': 'keyset', 'page_size': 10000}),
+    ('offset,page_size=10000,stream',
+     {'page_size': 10000, 'stream': True}),
+    ('keyset,page_size=10000,stream',
+     {'paging': 'keyset', 'page_size': 10000, 'stream': True}),
+    ('dump', {'paging': 'dump', 'page_size': 10000}),
+]
+
+
+BATCH_FORMATS = ['dict', 'numpy', 'arrow']
+
+
+def _is_available(format):
+    try:
+        columnar.check_format(format)
+    except ImportError:
+        return False
+    return True
+
+
+def _make_columns(columns, format):
+    if format == 'numpy':
+        return {name: columnar.numpy.array(values, dtype=object)
+                for name, values in columns.items()}
+    if format == 'arrow':
+        return columnar.pyarrow.table(columns)
+    return columns
+
+
+def _timed(function):
+    start = time.time()
+    value = function()
+    return value, time.time() - start
+
+
+def _result(name, rows, columns, seconds, count):
+    return collections.OrderedDict([
+        ('name', name),
+        ('rows', rows),
+        ('columns', columns),
+        ('seconds', round(seconds, 4)),
+        ('rows_per_second', round(count / seconds, 1) if seconds else None),
+    ])
+
+
+def _key(result):
+    return '{}/{}x{}'.format(result['name'], result['rows'], result['columns'])
+
+
+def _parse_list(text):
+    return [int(value) for value in text.split(',')]
+
+
+if __name__ == '__main__':
+    sys.exit(main())
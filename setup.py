@@ -22,7 +22,8 @@ PACKAGE = 'tableschema_ckan_datastore'
 NAME = PACKAGE.replace('_', '-')
 INSTALL_REQUIRES = [
     'six>=1.9',
-    'tableschema>=1.0'
+    'tableschema>=1.0',
+    'futures>=3.0; python_version<"3"'
 ]
 TESTS_REQUIRE = [
     'mock',
@@ -33,6 +34,19 @@ TESTS_REQUIRE = [
     'python-dotenv',
     'requests-mock'
 ]
+ASYNC_REQUIRE = [
+    'aiohttp>=3.0; python_version>="3.6"'
+]
+JSON_REQUIRE = [
+    'orjson>=3.0; python_version>="3.6"'
+]
+STREAM_REQUIRE = [
+    'ijson>=3.1'
+]
+COLUMNAR_REQUIRE = [
+    'numpy; python_version>="3.6"',
+    'pyarrow; python_version>="3.6"'
+]
 README = read('README.md')
 VERSION = read(PACKAGE, 'VERSION')
 PACKAGES = find_packages(exclude=['examples', 'tests'])
@@ -46,7 +60,12 @@ setup(
     include_package_data=True,
     install_requires=INSTALL_REQUIRES,
     tests_require=TESTS_REQUIRE,
-    extras_require={'develop': TESTS_REQUIRE},
+    extras_require={'develop': TESTS_REQUIRE + ASYNC_REQUIRE + JSON_REQUIRE +
+                    STREAM_REQUIRE,
+                    'async': ASYNC_REQUIRE,
+                    'json': JSON_REQUIRE,
+                    'stream': STREAM_REQUIRE,
+                    'columnar': COLUMNAR_REQUIRE},
     zip_safe=False,
     long_description=README,
     long_description_content_type='text/markdown',
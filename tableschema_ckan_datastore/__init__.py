@@ -8,7 +8,15 @@ from __future__ import unicode_literals
 
 # Module API
 
-from .storage import Storage
+from .storage import Storage, RequestError
+from .cache import Cache, MemoryCache, FileCache
+from .json_backend import JSONBackend
+from .metrics import Metrics, InMemoryMetrics, StatsdMetrics
+from .sync import FingerprintIndex
+from .writer import BatchWriteError, BatchSizer, Checkpoint
+import sys
+if sys.version_info >= (3, 6):
+    from .async_storage import AsyncStorage
 
 
 # Version
@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import six
+import json
+import asyncio
+import tableschema
+
+from . import utils
+from .mapper import Mapper
+from .json_backend import get_backend
+from .writer import Batch, BatchWriteError
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Module API
+
+class AsyncStorage(object):
+    """Ckan Datastore storage for asyncio
+
+    It has the same API as `Storage` but all the methods are coroutines,
+    `buckets` included, and `iter` is an asynchronous generator. It requires
+    the `aiohttp` package (`pip install tableschema-ckan-datastore[async]`).
+
+    ```python
+    async with AsyncStorage(base_url) as storage:
+        async for row in storage.iter(resource_id):
+            print(row)
+    ```
+
+    # Arguments
+        base_url (str):
+            the base url (and scheme) for the CKAN instance (e.g. http://demo.ckan.org).
+        dataset_id (str):
+            id or name of the CKAN dataset we wish to use as the bucket source.
+            If missing, all tables in the DataStore are used.
+        api_key (str):
+            either a CKAN user api key or, if in the format `env\\:CKAN_API_KEY_NAME`,
+            an env var that defines an api key.
+        pool_size (int):
+            maximum number of HTTP connections open to the CKAN instance.
+        session (aiohttp.ClientSession):
+            session used for the requests instead of one owned by the storage.
+        json_backend (str/JSONBackend):
+            `orjson`, `ujson` or `json` library encoding the rows written
+            and decoding responses. Defaults to the fastest installed.
+        bucket_page_size (int):
+            number of buckets listed per request. The pages after the first
+            one are fetched concurrently.
+        compress (bool/int):
+            gzip the bodies of `datastore_upsert` requests, at this level
+            if it's an int. The server, or a proxy in front of it, has to
+            decode gzip requests.
+
+    """
+
+    # Public
+
+    def __init__(self, base_url, dataset_id=None, api_key=None,
+                 pool_size=10, session=None, json_backend=None,
+                 bucket_page_size=1000, compress=False):
+        if aiohttp is None:
+            message = 'AsyncStorage requires the "aiohttp" package'
+            raise ImportError(message)
+
+        # Set attributes
+        base_path = "/api/3/action"
+        self.__base_url = base_url.rstrip('/')
+        self.__base_endpoint = self.__base_url + base_path
+        self.__dataset_id = dataset_id
+        self.__api_key = api_key
+        self.__descriptors = {}
+        self.__bucket_page_size = bucket_page_size
+        self.__compress = compress
+        self.__bucket_cache = None
+        self.__pool_size = pool_size
+        self.__session = session
+        self.__own_session = session is None
+
+        self.__json = get_backend(json_backend)
+
+        # Create mapper
+        self.__mapper = Mapper(json_backend=self.__json)
+
+    def __repr__(self):
+
+        # Template and format
+        template = 'AsyncStorage <{base_url}>'
+        text = template.format(base_url=self.__base_url)
+
+        return text
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        '''Close the HTTP session owned by the storage.
+        '''
+        if self.__own_session and self.__session is not None:
+            await self.__session.close()
+            self.__session = None
+
+    async def buckets(self):
+        if self.__bucket_cache:
+            return self.__bucket_cache
+
+        params = {
+            'resource_id': '_table_metadata',
+            'limit': self.__bucket_page_size,
+            # Offset pages are only consistent in a stable order
+            'sort': 'name',
+        }
+        if self.__dataset_id is not None:
+            filter_ids = \
+                await self.__get_resource_ids_for_dataset(self.__dataset_id)
+            params.update({'filters': json.dumps({'name': filter_ids})})
+
+        datastore_search_url = \
+            "{}/datastore_search".format(self.__base_endpoint)
+
+        response = await self._make_ckan_request(datastore_search_url,
+                                                 params=params)
+
+        result = response['result']
+        buckets = [r['name'] for r in result['records']]
+
+        # Follow the links if the total isn't known
+        total = result.get('total')
+        if total is None:
+            while result['records']:
+                next_url = self.__base_url + result['_links']['next']
+                result = (await self._make_ckan_request(next_url))['result']
+                buckets.extend(r['name'] for r in result['records'])
+
+        # The server may return fewer rows than the limit
+        elif buckets:
+            page_size = len(buckets)
+            responses = await asyncio.gather(*[
+                self._make_ckan_request(datastore_search_url, params=dict(
+                    params, offset=offset, limit=page_size))
+                for offset in range(page_size, total, page_size)])
+            for response in responses:
+                records = response['result']['records']
+                buckets.extend(r['name'] for r in records)
+
+        self.__bucket_cache = buckets
+        return buckets
+
+    async def create(self, bucket, descriptor, force=False):
+
+        # Make lists
+        buckets = bucket
+        if isinstance(bucket, six.string_types):
+            buckets = [bucket]
+        descriptors = descriptor
+        if isinstance(descriptor, dict):
+            descriptors = [descriptor]
+
+        # Check buckets for existence
+        existing = [b for b in await self.buckets() if b in buckets]
+        if existing:
+            if not force:
+                message = 'Bucket "%s" already exists.' % existing[0]
+                raise tableschema.exceptions.StorageError(message)
+            await self.delete(existing)
+
+        # Define resources concurrently
+        for descriptor in descriptors:
+            tableschema.validate(descriptor)
+        datastore_create_url = \
+            "{}/datastore_create".format(self.__base_endpoint)
+        requests = []
+        for bucket, descriptor in zip(buckets, descriptors):
+            self.__descriptors[bucket] = descriptor
+            datastore_dict = \
+                self.__mapper.descriptor_to_datastore_dict(descriptor, bucket)
+            requests.append(self._make_ckan_request(
+                datastore_create_url, method='POST', json=datastore_dict))
+        await asyncio.gather(*requests)
+
+        # Invalidate cache
+        self.__bucket_cache = None
+
+    async def delete(self, bucket=None, ignore=False):
+
+        # Make lists
+        existing = await self.buckets()
+        buckets = bucket
+        if isinstance(bucket, six.string_types):
+            buckets = [bucket]
+        elif bucket is None:
+            buckets = list(reversed(existing))
+
+        # Check existent
+        missing = [b for b in buckets if b not in existing]
+        if missing:
+            if not ignore:
+                message = 'Bucket "%s" doesn\'t exist.' % missing[0]
+                raise tableschema.exceptions.StorageError(message)
+            buckets = [b for b in buckets if b in existing]
+
+        # Delete buckets concurrently
+        datastore_delete_url = \
+            "{}/datastore_delete".format(self.__base_endpoint)
+        requests = []
+        for bucket in buckets:
+            self.__descriptors.pop(bucket, None)
+            params = {
+                'resource_id': bucket,
+                'force': True
+            }
+            requests.append(self._make_ckan_request(
+                datastore_delete_url, method='POST', json=params))
+        await asyncio.gather(*requests)
+
+        # Invalidate cache
+        self.__bucket_cache = None
+
+    async def describe(self, bucket, descriptor=None):
+
+        # Set descriptor
+        if descriptor is not None:
+            self.__descriptors[bucket] = descriptor
+
+        # Get descriptor
+        else:
+            descriptor = self.__descriptors.get(bucket)
+            if descriptor is None:
+                datastore_search_url = \
+                    "{}/datastore_search".format(self.__base_endpoint)
+                params = {
+                    'limit': '0',
+                    'resource_id': bucket
+                }
+                response = await self._make_ckan_request(datastore_search_url,
+                                                         params=params)
+
+                fields = response['result']['fields']
+                descriptor = \
+                    self.__mapper.datastore_fields_to_descriptor(fields)
+
+        return descriptor
+
+    async def iter(self, bucket, page_size=None):
+        """Iterate over the rows of the bucket
+
+        The next page is requested while the rows of the current page are
+        being consumed.
+
+        # Arguments
+            page_size (int):
+                number of records requested per page. Defaults to the
+                DataStore default (100).
+
+        """
+        schema = tableschema.Schema(await self.describe(bucket))
+        restore_row = self.__mapper.compile_restore_row(schema)
+
+        datastore_search_url = \
+            "{}/datastore_search".format(self.__base_endpoint)
+        params = {
+            'resource_id': bucket
+        }
+        if page_size is not None:
+            params['limit'] = str(page_size)
+        page = asyncio.ensure_future(
+            self._make_ckan_request(datastore_search_url, params=params))
+        try:
+            while True:
+                response = await page
+                records = response['result']['records']
+                if not records:
+                    break
+                next_url = \
+                    self.__base_url + response['result']['_links']['next']
+                page = asyncio.ensure_future(
+                    self._make_ckan_request(next_url))
+                for record in records:
+                    yield restore_row(record)
+        finally:
+            page.cancel()
+
+    async def read(self, bucket, **options):
+        return [row async for row in self.iter(bucket, **options)]
+
+    async def write(self, bucket, rows, method=None,
+                    batch_size=10000, workers=None):
+        """Write rows to the bucket
+
+        # Arguments
+            rows (iterable):
+                rows as an iterable or an asynchronous iterable.
+            method (str):
+                `datastore_upsert` method. Defaults to `insert` for
+                buckets created or described here without a primary key
+                and to `upsert` otherwise.
+            batch_size (int):
+                maximum number of rows per `datastore_upsert` request.
+            workers (int):
+                number of batches sent concurrently.
+
+        # Raises
+            BatchWriteError:
+                if batches failed. It holds the row ranges which were
+                written and which failed.
+
+        """
+        schema = tableschema.Schema(await self.describe(bucket))
+        convert_row = self.__mapper.compile_convert_row(schema)
+        if method is None:
+            # Remote descriptors don't tell the primary key
+            descriptor = self.__descriptors.get(bucket)
+            method = 'upsert'
+            if descriptor is not None and not descriptor.get('primaryKey'):
+                method = 'insert'
+        params = {
+            'resource_id': bucket,
+            'method': method,
+            'force': True
+        }
+        pending = asyncio.Semaphore(workers or 1)
+        committed = []
+        failed = []
+        tasks = []
+
+        async def send(batch):
+            try:
+                await self.__send_batch(batch)
+            except Exception as exception:
+                failed.append((batch.start, batch.stop, exception))
+            else:
+                committed.append((batch.start, batch.stop))
+            finally:
+                pending.release()
+
+        async def submit(start, records):
+            await pending.acquire()
+            batch = Batch.encode(start, params, records, self.__json.dumps)
+            tasks.append(asyncio.ensure_future(send(batch)))
+
+        start = 0
+        records = []
+        try:
+            async for row in _aiter(rows):
+                records.append(self.__json.dumps(convert_row(row)))
+                if len(records) >= batch_size:
+                    await submit(start, records)
+                    start += len(records)
+                    records = []
+                # Stop producing as soon as a batch has failed
+                if failed:
+                    break
+            if records and not failed:
+                await submit(start, records)
+        finally:
+            await asyncio.gather(*tasks)
+        if failed:
+            raise BatchWriteError(sorted(committed),
+                                  sorted(failed, key=lambda f: f[:2]))
+
+    # Private
+
+    async def __get_resource_ids_for_dataset(self, dataset_id):
+        '''Get a list of resource ids for the passed dataset id.
+        '''
+        package_show_url = "{}/package_show".format(self.__base_endpoint)
+        response = await self._make_ckan_request(package_show_url,
+                                                 params=dict(id=dataset_id))
+
+        dataset = response['result']
+        resources = dataset['resources']
+        resource_ids = [r['id'] for r in resources]
+        return resource_ids
+
+    async def __send_batch(self, batch):
+        '''Send an encoded batch of records to `datastore_upsert`.
+        '''
+        datastore_upsert_url = \
+            "{}/datastore_upsert".format(self.__base_endpoint)
+        headers = {'Content-Type': 'application/json'}
+        body = utils.compress_body(batch.body, headers, self.__compress)
+        await self._make_ckan_request(
+            datastore_upsert_url, method='POST', data=body, headers=headers)
+
+    async def _make_ckan_request(self, url, method='GET', headers=None,
+                                 **kwargs):
+        if self.__session is None:
+            connector = aiohttp.TCPConnector(limit=self.__pool_size)
+            self.__session = aiohttp.ClientSession(connector=connector)
+        headers = utils.make_headers(headers=headers, api_key=self.__api_key)
+        async with self.__session.request(method, url, headers=headers,
+                                          **kwargs) as response:
+            try:
+                response = self.__json.loads(await response.read())
+            except ValueError:
+                log.error('Expected JSON in response from: {}'.format(url))
+                raise
+
+        ckan_error = utils.get_ckan_error(response)
+        if ckan_error:
+            msg = 'CKAN returned an error: ' + json.dumps(ckan_error)
+            raise tableschema.exceptions.StorageError(msg)
+
+        return response
+
+
+# Internal
+
+async def _aiter(rows):
+    if hasattr(rows, '__aiter__'):
+        async for row in rows:
+            yield row
+    else:
+        for row in rows:
+            yield row
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import os
+import json
+import time
+import hashlib
+import tempfile
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Module API
+
+class Cache(object):
+    """Metadata cache interface
+
+    `Storage` keeps bucket lists and descriptors of remote buckets in a
+    cache. Values are JSON serializable. A custom cache implements `get`,
+    `set` and `delete`.
+
+    # Arguments
+        ttl (float):
+            seconds after which values expire. If `None` they never expire.
+
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+
+    def get(self, key):
+        '''Return the value for `key`, or `None` if missing or expired.
+        '''
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        '''Set the value for `key`.
+        '''
+        raise NotImplementedError()
+
+    def delete(self, key):
+        '''Remove the value for `key`, if any.
+        '''
+        raise NotImplementedError()
+
+    # Private
+
+    def _get_expires(self):
+        if self.ttl is None:
+            return None
+        return time.time() + self.ttl
+
+    def _is_expired(self, expires):
+        return expires is not None and expires <= time.time()
+
+
+class MemoryCache(Cache):
+    """Cache values in memory for the lifetime of the process
+    """
+
+    def __init__(self, ttl=None):
+        super(MemoryCache, self).__init__(ttl=ttl)
+        self.__values = {}
+
+    def get(self, key):
+        expires, value = self.__values.get(key, (None, None))
+        if self._is_expired(expires):
+            self.delete(key)
+            return None
+        return value
+
+    def set(self, key, value):
+        self.__values[key] = (self._get_expires(), value)
+
+    def delete(self, key):
+        self.__values.pop(key, None)
+
+
+class FileCache(Cache):
+    """Cache values in JSON files so they are shared between processes
+
+    # Arguments
+        path (str):
+            directory holding the cache files. It's created if missing.
+        ttl (float):
+            seconds after which values expire. If `None` they never expire.
+
+    """
+
+    def __init__(self, path, ttl=None):
+        super(FileCache, self).__init__(ttl=ttl)
+        self.__path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def get(self, key):
+        try:
+            with io.open(self.__get_filename(key), encoding='utf-8') as file:
+                entry = json.load(file)
+        except (IOError, OSError, ValueError):
+            return None
+        if self._is_expired(entry['expires']):
+            self.delete(key)
+            return None
+        return entry['value']
+
+    def set(self, key, value):
+        entry = {'key': key, 'expires': self._get_expires(), 'value': value}
+        # Write to a temporary file first so readers never see partial files
+        fd, temp_path = tempfile.mkstemp(dir=self.__path, suffix='.tmp')
+        with io.open(fd, 'w', encoding='utf-8') as file:
+            file.write(json.dumps(entry, ensure_ascii=False))
+        _replace(temp_path, self.__get_filename(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.__get_filename(key))
+        except OSError:
+            pass
+
+    # Private
+
+    def __get_filename(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.__path, digest + '.json')
+
+
+# Internal
+
+_replace = getattr(os, 'replace', os.rename)
@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import six
+import collections
+import tableschema
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Module API
+
+# Formats of column batches and the packages they require
+FORMATS = {
+    'dict': None,
+    'numpy': 'numpy',
+    'arrow': 'pyarrow',
+}
+
+# NumPy dtypes of Table Schema types, others are kept as objects
+NUMPY_DTYPES = {
+    'integer': 'int64',
+    'number': 'float64',
+    'boolean': 'bool',
+    'year': 'int64',
+    'date': 'datetime64[D]',
+    'datetime': 'datetime64[us]',
+}
+
+
+def check_format(format):
+    '''Raise if the columns `format` is unknown or its package is missing.
+    '''
+    if format not in FORMATS:
+        message = 'Columns format "%s" is not supported.' % format
+        raise tableschema.exceptions.StorageError(message)
+    package = FORMATS[format]
+    if package is not None and globals()[package] is None:
+        message = 'Columns format "%s" requires the "%s" package' % (
+            format, package)
+        raise ImportError(message)
+
+
+def get_arrow_type(type):
+    '''Return the Arrow type of a Table Schema type. Objects, arrays and
+    unknown types are JSON or plain text.
+    '''
+    return {
+        'string': pyarrow.string(),
+        'integer': pyarrow.int64(),
+        'number': pyarrow.float64(),
+        'boolean': pyarrow.bool_(),
+        'year': pyarrow.int64(),
+        'date': pyarrow.date32(),
+        'datetime': pyarrow.timestamp('us'),
+        'time': pyarrow.time64('us'),
+    }.get(type, pyarrow.string())
+
+
+def compile_make_native_array(type, format, missing_values):
+    '''Return a function making a column from the values of a DataStore
+    response without casting them one by one, or returning `None` if they
+    aren't of the expected JSON types.
+    '''
+    native_types = NATIVE_TYPES[format].get(type)
+    if native_types is None:
+        return None
+    accepted = set(native_types + (_NoneType,))
+    # Only strings can be missing values
+    missing = set()
+    if six.text_type in native_types:
+        missing = set(missing_values)
+    make_array = compile_make_array(type, format)
+
+    def make_native_array(values):
+        if not set(map(_type, values)) <= accepted:
+            return None
+        if missing and not missing.isdisjoint(values):
+            values = [None if value in missing else value for value in values]
+        if format == 'dict':
+            return values
+        try:
+            if format == 'arrow' and type in ['date', 'datetime']:
+                # Arrow parses ISO 8601 strings column at once
+                return pyarrow.array(values, pyarrow.string()).cast(
+                    get_arrow_type(type))
+            return make_array(values)
+        except (ValueError, TypeError, _ArrowInvalid):
+            return None
+
+    return make_native_array
+
+
+def compile_make_array(type, format, dumps=None):
+    '''Return a function making a column from restored values, e.g. a NumPy
+    array of the type's dtype. `dumps` encodes objects and arrays as JSON
+    for Arrow.
+    '''
+    if format == 'dict':
+        return _identity
+
+    if format == 'numpy':
+        dtype = NUMPY_DTYPES.get(type)
+
+        def make_numpy_array(values):
+            if dtype is not None and None in values:
+                if type in ['integer', 'year']:
+                    return numpy.array(values, dtype='float64')
+                if type == 'boolean':
+                    return _make_object_array(values)
+            if dtype is not None:
+                try:
+                    return numpy.array(values, dtype=dtype)
+                except (ValueError, TypeError):
+                    # e.g. timezone aware datetimes
+                    pass
+            return _make_object_array(values)
+
+        return make_numpy_array
+
+    arrow_type = get_arrow_type(type)
+    if type == 'number':
+        convert = float
+    elif type in ['object', 'array', 'geojson'] and dumps is not None:
+        def convert(value):
+            return dumps(value).decode('utf-8')
+    elif arrow_type == pyarrow.string() and type != 'string':
+        convert = six.text_type
+    else:
+        convert = None
+
+    def make_arrow_array(values):
+        if convert is not None:
+            values = [None if value is None else convert(value)
+                      for value in values]
+        return pyarrow.array(values, arrow_type)
+
+    return make_arrow_array
+
+
+def make_batch(format, names, columns):
+    '''Return a batch of `columns` in the `format`.
+    '''
+    if format == 'arrow':
+        return pyarrow.RecordBatch.from_arrays(columns, names=names)
+    return collections.OrderedDict(zip(names, columns))
+
+
+def concat_batches(format, batches):
+    '''Return column `batches` concatenated: a dict of lists, a dict of
+    NumPy arrays or a pyarrow.Table.
+    '''
+    if format == 'arrow':
+        return pyarrow.Table.from_batches(batches)
+    columns = collections.OrderedDict()
+    for name in batches[0]:
+        if format == 'numpy':
+            columns[name] = numpy.concatenate([b[name] for b in batches])
+        else:
+            columns[name] = [v for b in batches for v in b[name]]
+    return columns
+
+
+def iter_column_slices(data, size):
+    '''Yield dicts of column lists of at most `size` rows from `data`: a
+    pandas.DataFrame, a pyarrow.Table or RecordBatch, a dict of column lists
+    or NumPy arrays, or an iterable of them. Nulls are `None` and temporal
+    values of NumPy and Arrow columns are ISO 8601 strings.
+    '''
+    if isinstance(data, dict) or _is_dataframe(data) or _is_arrow(data):
+        data = [data]
+    for part in data:
+        if _is_dataframe(part):
+            names = [six.text_type(name) for name in part.columns]
+            length = len(part)
+            get = _get_pandas_slice
+        elif _is_arrow(part):
+            names = part.schema.names
+            length = part.num_rows
+            get = _get_arrow_slice
+        elif isinstance(part, dict):
+            names = list(part)
+            length = len(part[names[0]]) if names else 0
+            get = _get_dict_slice
+        else:
+            message = 'Columns of type "%s" are not supported.' % (
+                type(part).__name__)
+            raise tableschema.exceptions.StorageError(message)
+        for start in range(0, length, size):
+            yield get(part, names, start, min(start + size, length))
+
+
+def iter_records(columns):
+    '''Yield a record dict per row of a dict of column lists.
+    '''
+    names = list(columns)
+    for values in zip(*columns.values()):
+        yield dict(zip(names, values))
+
+
+# Internal
+
+# JSON types of DataStore values which need no casting, by format
+NATIVE_TYPES = {
+    'dict': {
+        'string': (six.text_type,),
+        'integer': six.integer_types,
+        'boolean': (bool,),
+        'object': (dict,),
+        'array': (list,),
+    },
+    'numpy': {
+        'string': (six.text_type,),
+        'integer': six.integer_types,
+        'number': six.integer_types + (float,),
+        'boolean': (bool,),
+        'year': six.integer_types,
+        'date': (six.text_type,),
+        'datetime': (six.text_type,),
+    },
+    'arrow': {
+        'string': (six.text_type,),
+        'integer': six.integer_types,
+        'number': six.integer_types + (float,),
+        'boolean': (bool,),
+        'year': six.integer_types,
+        'date': (six.text_type,),
+        'datetime': (six.text_type,),
+    },
+}
+
+_type = type
+_NoneType = type(None)
+_ArrowInvalid = pyarrow.ArrowInvalid if pyarrow is not None else ValueError
+
+
+def _identity(values):
+    return values
+
+
+def _make_object_array(values):
+    array = numpy.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def _is_dataframe(data):
+    return type(data).__name__ == 'DataFrame' and hasattr(data, 'iloc')
+
+
+def _is_arrow(data):
+    return pyarrow is not None and \
+        isinstance(data, (pyarrow.Table, pyarrow.RecordBatch))
+
+
+def _get_dict_slice(data, names, start, stop):
+    columns = collections.OrderedDict()
+    for name in names:
+        values = data[name][start:stop]
+        if numpy is not None and isinstance(values, numpy.ndarray):
+            values = _numpy_to_list(values)
+        columns[name] = list(values)
+    return columns
+
+
+def _get_pandas_slice(data, names, start, stop):
+    columns = collections.OrderedDict()
+    for name, (_, series) in zip(names, data.iloc[start:stop].items()):
+        values = series.to_numpy()
+        if isinstance(series.dtype, numpy.dtype) and \
+                series.dtype.kind in 'biufM':
+            columns[name] = _numpy_to_list(values)
+            continue
+        # Object and extension columns, e.g. nullable integers
+        values = series.to_numpy(dtype=object).tolist()
+        for index in numpy.flatnonzero(series.isna().to_numpy()):
+            values[index] = None
+        columns[name] = values
+    return columns
+
+
+def _get_arrow_slice(data, names, start, stop):
+    columns = collections.OrderedDict()
+    part = data.slice(start, stop - start)
+    for name, array in zip(names, part.columns):
+        if pyarrow.types.is_timestamp(array.type) or \
+                pyarrow.types.is_date(array.type):
+            # Arrow formats them as ISO 8601 much faster than Python
+            array = array.cast(pyarrow.string())
+        columns[name] = array.to_pylist()
+    return columns
+
+
+def _numpy_to_list(array):
+    if array.dtype.kind == 'M':
+        nulls = numpy.isnat(array)
+        values = numpy.datetime_as_string(array).tolist()
+    elif array.dtype.kind == 'f':
+        nulls = numpy.isnan(array)
+        values = array.tolist()
+    elif array.dtype.kind == 'O':
+        # NaN is the only value which isn't equal to itself
+        try:
+            nulls = numpy.asarray(array != array, dtype=bool)
+        except (ValueError, TypeError):
+            nulls = numpy.array([value is None for value in array])
+        values = array.tolist()
+    else:
+        return array.tolist()
+    for index in numpy.flatnonzero(nulls):
+        values[index] = None
+    return values
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import six
+import decimal
+import datetime
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Module API
+
+class JSONBackend(object):
+    """JSON encoding and decoding of request and response bodies
+
+    It uses `orjson` or `ujson` if installed, which are much faster than the
+    standard library `json`. Decimals, dates, times and datetimes are
+    encoded by every backend, so rows with typed values can be written
+    without converting them first. Decimals are encoded as strings to keep
+    their precision, except by `ujson` which encodes them as floats itself.
+
+    # Arguments
+        name (str):
+            `orjson`, `ujson` or `json`. Defaults to the fastest installed.
+
+    """
+
+    def __init__(self, name=None):
+        if name is None:
+            name = next(n for n in BACKENDS if _import(n) is not None)
+        module = _import(name)
+        if module is None:
+            message = 'JSON backend "%s" is not installed.' % name
+            raise ValueError(message)
+        self.name = name
+        self.__module = module
+
+    def __repr__(self):
+        return 'JSONBackend <{}>'.format(self.name)
+
+    def dumps(self, value):
+        '''Return `value` encoded as UTF-8 JSON bytes.
+        '''
+        if self.name == 'orjson':
+            return self.__module.dumps(value, default=_default)
+        return self.__module.dumps(
+            value, ensure_ascii=False, default=_default).encode('utf-8')
+
+    def loads(self, data):
+        '''Return the value of JSON `data`, as bytes or text.
+        '''
+        if self.name == 'json' and isinstance(data, six.binary_type):
+            data = data.decode('utf-8')
+        return self.__module.loads(data)
+
+
+def get_backend(backend=None):
+    '''Return a `JSONBackend` from a backend, its name or `None` for the
+    default one.'''
+    if isinstance(backend, JSONBackend):
+        return backend
+    if backend is None:
+        global _default_backend
+        if _default_backend is None:
+            _default_backend = JSONBackend()
+        return _default_backend
+    return JSONBackend(backend)
+
+
+# Internal
+
+BACKENDS = ['orjson', 'ujson', 'json']
+_default_backend = None
+
+
+def _import(name):
+    try:
+        return __import__(name)
+    except ImportError:
+        return None
+
+
+def _default(value):
+    if isinstance(value, decimal.Decimal):
+        if value == value.to_integral_value():
+            return int(value)
+        # DataStore numeric columns take them as text without rounding
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    raise TypeError('Object of type {} is not JSON serializable'.format(
+        type(value).__name__))
@@ -6,9 +6,14 @@ from __future__ import unicode_literals
 
 import six
 import json
+import weakref
+import datetime
 import dateutil
 import tableschema
 
+from . import columnar
+from .json_backend import get_backend
+
 import logging
 log = logging.getLogger(__name__)
 
@@ -19,9 +24,21 @@ class Mapper(object):
 
     # Public
 
+    def __init__(self, json_backend=None):
+        self.__restorers = {}
+        self.__converters = {}
+        self.__column_restorers = {}
+        self.__schema_keys = weakref.WeakKeyDictionary()
+        self.__json = get_backend(json_backend)
+
     def descriptor_to_datastore_dict(self, descriptor, bucket):
         '''
         Return a datastore dict from a table schema descriptor.
+
+        Field titles and descriptions are the labels and notes of the
+        DataStore data dictionary. Fields of the `indexes` descriptor
+        property, a list of field names or lists of them, and foreign key
+        fields are indexed.
         '''
         schema = tableschema.Schema(descriptor)
         datastore_dict = {
@@ -36,11 +53,21 @@ class Mapper(object):
             datastore_type = self.descritor_type_to_datastore_type(field.type)
             if datastore_type:
                 datastore_field['type'] = datastore_type
+            info = {}
+            if field.descriptor.get('title'):
+                info['label'] = field.descriptor['title']
+            if field.descriptor.get('description'):
+                info['notes'] = field.descriptor['description']
+            if info:
+                datastore_field['info'] = info
             datastore_dict['fields'].append(datastore_field)
 
         pk = descriptor.get('primaryKey', None)
         if pk is not None:
             datastore_dict['primary_key'] = pk
+        indexes = self.__get_indexes(descriptor)
+        if indexes:
+            datastore_dict['indexes'] = indexes
         return datastore_dict
 
     def descritor_type_to_datastore_type(self, type):
@@ -86,6 +113,11 @@ class Mapper(object):
             }
             if ts_format is not None:
                 ts_field['format'] = ts_format
+            info = f.get('info') or {}
+            if info.get('label'):
+                ts_field['title'] = info['label']
+            if info.get('notes'):
+                ts_field['description'] = info['notes']
             ts_fields.append(ts_field)
 
         return {'fields': ts_fields}
@@ -133,34 +165,262 @@ class Mapper(object):
     def restore_row(self, record, schema):
         """Restore row from DataStore record
         """
-        row = {}
-        for field in schema.fields:
-            value = record[field.name]
-            if field.type == 'datetime' and value is not None:
-                value = dateutil.parser.parse(value)
-            row[field.name] = field.cast_value(value)
-        return row
+        return self.compile_restore_row(schema)(record)
 
     def convert_row(self, row, schema):
         """Convert row to DataStore record
         """
-        record = {}
-        for i, f in enumerate(schema.fields):
-            value = self._uncast_value(row[i], f)
-            record[f.name] = value
-        return record
+        return self.compile_convert_row(schema)(row)
+
+    def compile_restore_row(self, schema):
+        """Return a function restoring rows from DataStore records
+
+        Per-field casting is resolved once per schema descriptor, so the
+        returned function only applies the field restorers to the values.
+        """
+        key = self.__get_schema_key(schema)
+        restore_row = self.__restorers.get(key)
+        if restore_row is None:
+            columns = tuple((field.name, self.__compile_restore_value(field))
+                            for field in schema.fields)
+
+            def restore_row(record):
+                return {name: restore(record[name])
+                        for name, restore in columns}
+
+            self.__restorers[key] = restore_row
+        return restore_row
+
+    def compile_restore_columns(self, schema, format='dict'):
+        """Return a function restoring a list of DataStore records to columns
+
+        The batch is a dict of lists, a dict of NumPy arrays or a
+        `pyarrow.RecordBatch` depending on `format`. Columns of JSON values
+        which need no casting are made at once, only the others are cast
+        value by value.
+        """
+        columnar.check_format(format)
+        key = (self.__get_schema_key(schema), format)
+        restore_columns = self.__column_restorers.get(key)
+        if restore_columns is None:
+            names = tuple(schema.field_names)
+            columns = tuple(self.__compile_restore_column(field, format)
+                            for field in schema.fields)
+
+            def restore_columns(records):
+                return columnar.make_batch(format, names, [
+                    restore([record[name] for record in records])
+                    for name, restore in zip(names, columns)])
+
+            self.__column_restorers[key] = restore_columns
+        return restore_columns
+
+    def compile_convert_columns(self, schema):
+        """Return a function converting a dict of column lists to DataStore
+        values
+
+        Columns are only converted if they hold values to convert, e.g.
+        empty strings of numeric fields or JSON text of object fields.
+        """
+        converters = []
+        for field in schema.fields:
+            convert = self.__compile_uncast_value(field)
+            if convert is not None:
+                # Empty strings are found without a Python loop
+                needs_convert = _has_empty if convert is _uncast_empty \
+                    else _has_text
+                converters.append((field.name, convert, needs_convert))
+
+        def convert_columns(columns):
+            for name, convert, needs_convert in converters:
+                values = columns.get(name)
+                if values is not None and needs_convert(values):
+                    columns[name] = [convert(value) for value in values]
+            return columns
+
+        return convert_columns
+
+    def compile_convert_row(self, schema):
+        """Return a function converting rows to DataStore records
+
+        Only fields which need their values converted get a converter, the
+        other values are copied as they are.
+        """
+        key = self.__get_schema_key(schema)
+        convert_row = self.__converters.get(key)
+        if convert_row is None:
+            names = tuple(field.name for field in schema.fields)
+            size = len(names)
+            converters = []
+            for field in schema.fields:
+                convert = self.__compile_uncast_value(field)
+                if convert is not None:
+                    converters.append((field.name, convert))
+            converters = tuple(converters)
+
+            def convert_row(row):
+                if len(row) < size:
+                    raise IndexError('Row has {} values for {} fields'.format(
+                        len(row), size))
+                record = dict(zip(names, row))
+                for name, convert in converters:
+                    record[name] = convert(record[name])
+                return record
+
+            self.__converters[key] = convert_row
+        return convert_row
+
+    # Private
+
+    def __get_indexes(self, descriptor):
+        '''Return the DataStore indexes of the descriptor `indexes` and
+        foreign keys, as comma separated field names.
+        '''
+        keys = descriptor.get('indexes', [])
+        if isinstance(keys, six.string_types):
+            keys = [keys]
+        keys = list(keys)
+        keys.extend(fk['fields'] for fk in descriptor.get('foreignKeys', []))
+        primary_key = _get_index(descriptor.get('primaryKey', []))
+        indexes = []
+        for key in keys:
+            index = _get_index(key)
+            # The primary key already has an index
+            if index and index != primary_key and index not in indexes:
+                indexes.append(index)
+        return indexes
+
+    def __get_schema_key(self, schema):
+        # Equal descriptors share compiled functions, but each schema is
+        # serialized once
+        key = self.__schema_keys.get(schema)
+        if key is None:
+            key = json.dumps(schema.descriptor, sort_keys=True)
+            self.__schema_keys[schema] = key
+        return key
+
+    def __compile_restore_value(self, field):
+        if field.type == 'datetime':
+            missing_values = field.missing_values
+
+            def cast_datetime_value(value):
+                if value not in missing_values and value is not None:
+                    value = _parse_datetime(value)
+                return field.cast_value(value)
 
-    def _uncast_value(self, value, field):
+            def cast_datetime_function(value):
+                return field.cast_function(_parse_datetime(value))
+
+            cast_value = cast_datetime_value
+            cast_function = cast_datetime_function
+        else:
+            cast_value = field.cast_value
+            cast_function = field.cast_function
+
+        # Fields with constraints go through the full casting
+        if field.check_functions:
+            return cast_value
+
+        missing_values = tuple(field.missing_values)
+        native_type = None
+        if field.format == 'default':
+            native_type = JSON_NATIVE_TYPES.get(field.type)
+
+        def restore_value(value):
+            if value is None:
+                return None
+            if value in missing_values:
+                return cast_value(value)
+            if type(value) is native_type:
+                return value
+            restored = cast_function(value)
+            if restored is tableschema.config.ERROR:
+                # Raise the casting error
+                return cast_value(value)
+            return restored
+
+        return restore_value
+
+    def __compile_restore_column(self, field, format):
+        restore_value = self.__compile_restore_value(field)
+        make_array = columnar.compile_make_array(field.type, format,
+                                                 dumps=self.__json.dumps)
+        make_native_array = None
+        if not field.check_functions and field.format == 'default':
+            make_native_array = columnar.compile_make_native_array(
+                field.type, format, field.missing_values)
+
+        def restore_column(values):
+            if make_native_array is not None:
+                array = make_native_array(values)
+                if array is not None:
+                    return array
+            return make_array([restore_value(value) for value in values])
+
+        return restore_column
+
+    def __compile_uncast_value(self, field):
         if field.type in ['integer',
                           'number',
                           'year',
                           'date',
                           'datetime',
-                          'time'] and value == '':
-            return None
+                          'time']:
+            return _uncast_empty
         if field.type in ['array', 'object', 'geojson']:
-            if isinstance(value, six.string_types) and value != '':
-                return json.loads(value)
-            else:
-                return None
-        return value
+            loads = self.__json.loads
+
+            def uncast_json(value):
+                if isinstance(value, six.string_types):
+                    return loads(value) if value != '' else None
+                # Values cast by the schema are already decoded
+                return value
+
+            return uncast_json
+        return None
+
+
+# Internal
+
+# Types of values in DataStore JSON responses which need no casting
+JSON_NATIVE_TYPES = {
+    'string': six.text_type,
+    'integer': int,
+    'boolean': bool,
+    'object': dict,
+    'array': list,
+}
+
+
+def _parse_datetime(value):
+    # DataStore timestamps are ISO 8601, which is much faster to parse with
+    # `fromisoformat` where it's available (Python 3.7+)
+    if _fromisoformat is not None and isinstance(value, six.string_types):
+        try:
+            return _fromisoformat(value)
+        except ValueError:
+            pass
+    return dateutil.parser.parse(value)
+
+
+_fromisoformat = getattr(datetime.datetime, 'fromisoformat', None)
+
+
+def _get_index(fields):
+    if isinstance(fields, six.string_types):
+        return fields
+    return ','.join(fields)
+
+
+def _uncast_empty(value):
+    if value == '':
+        return None
+    return value
+
+
+def _has_empty(values):
+    return '' in values
+
+
+def _has_text(values):
+    return any(isinstance(value, six.string_types) for value in values)
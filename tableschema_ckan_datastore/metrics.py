@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import socket
+import threading
+import collections
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Module API
+
+class Metrics(object):
+    """Instrumentation hooks
+
+    `Storage` calls `on_request` after every CKAN request and `on_phase`
+    once per `iter` and `write` call for each of their phases. This base
+    class ignores them; subclasses override the hooks they need.
+
+    """
+
+    def on_request(self, action, method, url, status, bytes_sent,
+                   bytes_received, seconds, retries=0, error=None):
+        '''Called after a CKAN request
+
+        # Arguments
+            action (str): CKAN action, e.g. `datastore_search`.
+            method (str): HTTP method.
+            url (str): requested url.
+            status (int): HTTP status, or `None` if no response was received.
+            bytes_sent (int): size of the request body.
+            bytes_received (int):
+                size of the response body, or `None` if it's streamed.
+            seconds (float): time until the response was received.
+            retries (int): number of retried attempts.
+            error (dict/Exception): CKAN error or exception, if any.
+
+        '''
+        pass
+
+    def on_phase(self, phase, bucket, seconds, rows):
+        '''Called when an `iter` or `write` call is finished
+
+        # Arguments
+            phase (str):
+                `fetch` and `restore` for `iter`, `convert` and `send` for
+                `write`. `send` is the time spent waiting for batches.
+            bucket (str): bucket name.
+            seconds (float): time spent in the phase.
+            rows (int): number of rows processed.
+
+        '''
+        pass
+
+
+class InMemoryMetrics(Metrics):
+    """Aggregate requests by action and phases in memory
+
+    ```python
+    metrics = InMemoryMetrics()
+    storage = Storage(base_url, metrics=metrics)
+    storage.read(resource_id)
+    print(metrics.summary())
+    ```
+
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__requests = collections.defaultdict(_RequestStats)
+        self.__phases = collections.defaultdict(_PhaseStats)
+
+    def on_request(self, action, method, url, status, bytes_sent,
+                   bytes_received, seconds, retries=0, error=None):
+        with self.__lock:
+            stats = self.__requests[action]
+            stats.count += 1
+            stats.errors += error is not None
+            stats.retries += retries
+            stats.bytes_sent += bytes_sent or 0
+            stats.bytes_received += bytes_received or 0
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+    def on_phase(self, phase, bucket, seconds, rows):
+        with self.__lock:
+            stats = self.__phases[phase]
+            stats.count += 1
+            stats.seconds += seconds
+            stats.rows += rows
+
+    def summary(self):
+        '''Return the aggregates as `{'requests': {action: {...}},
+        'phases': {phase: {...}}}`.
+        '''
+        with self.__lock:
+            return {
+                'requests': {action: dict(vars(stats))
+                             for action, stats in self.__requests.items()},
+                'phases': {phase: dict(vars(stats))
+                           for phase, stats in self.__phases.items()},
+            }
+
+    def render_prometheus(self, prefix='ckan_datastore'):
+        '''Return the aggregates in the Prometheus text exposition format.
+        '''
+        summary = self.summary()
+        lines = []
+        for name, label, group in [('requests', 'action', 'requests'),
+                                   ('phase', 'phase', 'phases')]:
+            for key, stats in sorted(summary[group].items()):
+                for stat, value in sorted(stats.items()):
+                    lines.append('{}_{}_{}{{{}="{}"}} {}'.format(
+                        prefix, name, stat, label, key, value))
+        return '\n'.join(lines) + '\n'
+
+
+class StatsdMetrics(Metrics):
+    """Send requests and phases to a StatsD server over UDP
+
+    Requests are sent as `<prefix>.request.<action>` timers and counters of
+    bytes, retries and errors. Phases are sent as `<prefix>.phase.<phase>`
+    timers and row counters.
+
+    # Arguments
+        host (str): StatsD host.
+        port (int): StatsD port.
+        prefix (str): prefix of the metric names.
+
+    """
+
+    def __init__(self, host='localhost', port=8125, prefix='ckan_datastore'):
+        self.__address = (host, port)
+        self.__prefix = prefix
+        self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def on_request(self, action, method, url, status, bytes_sent,
+                   bytes_received, seconds, retries=0, error=None):
+        name = '{}.request.{}'.format(self.__prefix, action)
+        self.__send([
+            '{}.time:{:.3f}|ms'.format(name, seconds * 1000),
+            '{}.bytes_sent:{}|c'.format(name, bytes_sent or 0),
+            '{}.bytes_received:{}|c'.format(name, bytes_received or 0),
+            '{}.retries:{}|c'.format(name, retries),
+            '{}.errors:{}|c'.format(name, int(error is not None)),
+        ])
+
+    def on_phase(self, phase, bucket, seconds, rows):
+        name = '{}.phase.{}'.format(self.__prefix, phase)
+        self.__send([
+            '{}.time:{:.3f}|ms'.format(name, seconds * 1000),
+            '{}.rows:{}|c'.format(name, rows),
+        ])
+
+    # Private
+
+    def __send(self, lines):
+        try:
+            self.__socket.sendto('\n'.join(lines).encode('utf-8'),
+                                 self.__address)
+        except (IOError, OSError) as exception:
+            log.warn('Failed to send metrics: {}'.format(exception))
+
+
+# Internal
+
+class _RequestStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.seconds = 0
+        self.max_seconds = 0
+
+
+class _PhaseStats(object):
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0
+        self.rows = 0
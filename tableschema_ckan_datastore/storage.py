@@ -4,13 +4,32 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import io
+import csv
 import six
 import json
+import requests
+import timeit
+import threading
+import functools
+import itertools
+import contextlib
 import collections
 import tableschema
 
+from . import sync
 from . import utils
+from . import columnar
+from .cache import MemoryCache
+from .json_backend import get_backend
 from .mapper import Mapper
+from .sync import FingerprintIndex
+from .writer import Batch, BatchSizer, BatchWriter, Checkpoint
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 import logging
 log = logging.getLogger(__name__)
@@ -18,6 +37,19 @@ log = logging.getLogger(__name__)
 
 # Module API
 
+class RequestError(tableschema.exceptions.StorageError):
+    """A CKAN request failed with an HTTP error status
+
+    # Arguments
+        response (requests.Response): the error response.
+
+    """
+
+    def __init__(self, message, response):
+        self.response = response
+        super(RequestError, self).__init__(message)
+
+
 class Storage(tableschema.Storage):
     """Ckan Datastore storage
 
@@ -38,12 +70,58 @@ class Storage(tableschema.Storage):
         api_key (str):
             either a CKAN user api key or, if in the format `env\\:CKAN_API_KEY_NAME`,
             an env var that defines an api key.
+        pool_size (int):
+            maximum number of HTTP connections kept open to the CKAN instance.
+            It should be at least the number of `workers` used for writing.
+        keep_alive (bool):
+            reuse HTTP connections between requests.
+        adapter (requests.adapters.BaseAdapter):
+            custom transport adapter mounted on the HTTP session instead
+            of a pooled `HTTPAdapter`.
+        cache (Cache):
+            cache for bucket lists and descriptors of remote buckets, e.g.
+            `FileCache(path, ttl=600)` to share them between processes.
+            Defaults to a `MemoryCache` without expiry.
+        metrics (Metrics):
+            instrumentation receiving every request and the time spent in
+            the phases of `iter` and `write`, e.g. `InMemoryMetrics()`.
+        timeout (float/tuple):
+            seconds to wait for the server, passed to `requests`.
+        retries (int):
+            number of times reads and `upsert` batches are retried after a
+            connection error, a timeout or a 429, 502, 503 or 504 status.
+        backoff_factor (float):
+            seconds before the first retry, doubled for each following
+            one, with a random jitter.
+        json_backend (str/JSONBackend):
+            `orjson`, `ujson` or `json` library encoding the rows written
+            and decoding responses. Defaults to the fastest installed.
+        bucket_workers (int):
+            number of buckets created, deleted or written concurrently by
+            calls on several buckets.
+        bucket_page_size (int):
+            number of buckets listed per request. The pages after the first
+            one are fetched concurrently, by `bucket_workers` threads or
+            `pool_size` threads if it's not set.
+        package_buckets (bool):
+            list the resources of `dataset_id` which are in the DataStore
+            from `package_show` alone, without searching the DataStore
+            table list.
+        compress (bool/int):
+            gzip the bodies of `datastore_upsert` requests, at this level
+            if it's an int. The server, or a proxy in front of it, has to
+            decode gzip requests. Responses are always requested gzipped.
 
     """
 
     # Public
 
-    def __init__(self, base_url, dataset_id=None, api_key=None):
+    def __init__(self, base_url, dataset_id=None, api_key=None,
+                 pool_size=10, keep_alive=True, adapter=None, cache=None,
+                 metrics=None, timeout=None, retries=0, backoff_factor=0.5,
+                 json_backend=None, bucket_workers=None,
+                 bucket_page_size=1000, package_buckets=False,
+                 compress=False):
 
         # Set attributes
         base_path = "/api/3/action"
@@ -52,11 +130,26 @@ class Storage(tableschema.Storage):
         self.__dataset_id = dataset_id
         self.__api_key = api_key
         self.__descriptors = {}
-        self.__max_pages = 100
-        self.__bucket_cache = None
+        self.__cache = cache if cache is not None else MemoryCache()
+        self.__metrics = metrics
+        self.__timeout = timeout
+        self.__retries = retries
+        self.__backoff_factor = backoff_factor
+        self.__json = get_backend(json_backend)
+        self.__bucket_workers = bucket_workers
+        self.__bucket_page_size = bucket_page_size
+        self.__package_buckets = package_buckets
+        self.__pool_size = pool_size
+        self.__compress = compress
+        self.__cache_lock = threading.Lock()
+
+        # Create HTTP session
+        self.__session = utils.make_session(pool_size=pool_size,
+                                            keep_alive=keep_alive,
+                                            adapter=adapter)
 
         # Create mapper
-        self.__mapper = Mapper()
+        self.__mapper = Mapper(json_backend=self.__json)
 
     def __repr__(self):
 
@@ -68,37 +161,16 @@ class Storage(tableschema.Storage):
 
     @property
     def buckets(self):
-        if self.__bucket_cache:
-            return self.__bucket_cache
-
-        params = {
-            'resource_id': '_table_metadata'
-        }
-        if self.__dataset_id is not None:
-            filter_ids = self.__get_resource_ids_for_dataset(self.__dataset_id)
-            params.update({'filters': json.dumps({'name': filter_ids})})
+        buckets = self.__cache.get(self.__get_cache_key('buckets'))
+        if buckets is not None:
+            return buckets
 
-        datastore_search_url = \
-            "{}/datastore_search".format(self.__base_endpoint)
-
-        response = self._make_ckan_request(datastore_search_url, params=params)
-
-        buckets = [r['name'] for r in response['result']['records']]
-
-        count = 1
-        while response['result']['records']:
-            count += 1
-            next_url = self.__base_url + response['result']['_links']['next']
-            response = self._make_ckan_request(next_url)
-            records = response['result']['records']
-            if records:
-                buckets = buckets + [r['name']
-                                     for r in response['result']['records']]
-            if count == self.__max_pages:
-                log.warn("Max bucket count exceeded. {} buckets returned."
-                         .format(len(buckets)))
-                break
-        self.__bucket_cache = buckets
+        if self.__dataset_id is not None and self.__package_buckets:
+            resources = self.__get_resources_for_dataset(self.__dataset_id)
+            buckets = [r['id'] for r in resources if r.get('datastore_active')]
+        else:
+            buckets = self.__list_table_metadata()
+        self.__cache.set(self.__get_cache_key('buckets'), buckets)
         return buckets
 
     def create(self, bucket, descriptor, force=False):
@@ -112,59 +184,43 @@ class Storage(tableschema.Storage):
             descriptors = [descriptor]
 
         # Check buckets for existence
-        for bucket in reversed(self.buckets):
-            if bucket in buckets:
-                if not force:
-                    message = 'Bucket "%s" already exists.' % bucket
-                    raise tableschema.exceptions.StorageError(message)
-                self.delete(bucket)
-
-        # Iterate over buckets/descriptors
-        for bucket, descriptor in zip(buckets, descriptors):
-            # Define resources
+        existent = set(self.buckets)
+        existent = [bucket for bucket in buckets if bucket in existent]
+        if existent:
+            if not force:
+                message = 'Bucket "%s" already exists.' % existent[0]
+                raise tableschema.exceptions.StorageError(message)
+            self.delete(existent)
+
+        # Validate descriptors before creating any bucket
+        for descriptor in descriptors:
             tableschema.validate(descriptor)
-            self.__descriptors[bucket] = descriptor
-            datastore_dict = \
-                self.__mapper.descriptor_to_datastore_dict(descriptor, bucket)
-            datastore_create_url = \
-                "{}/datastore_create".format(self.__base_endpoint)
-            self._make_ckan_request(datastore_create_url, method='POST',
-                                    json=datastore_dict)
 
-        # Invalidate cache
-        self.__bucket_cache = None
+        # Create buckets
+        utils.run_concurrently(lambda item: self.__create_bucket(*item),
+                               zip(buckets, descriptors),
+                               workers=self.__bucket_workers)
 
     def delete(self, bucket=None, ignore=False):
         # Make lists
         buckets = bucket
         if isinstance(bucket, six.string_types):
             buckets = [bucket]
-        elif bucket is None:
-            buckets = reversed(self.buckets)
+        existent = self.buckets
+        if bucket is None:
+            buckets = list(reversed(existent))
 
+        # Check buckets for existence
+        existent = set(existent)
         for bucket in buckets:
-            # Check existent
-            if bucket not in self.buckets:
-                if not ignore:
-                    message = 'Bucket "%s" doesn\'t exist.' % bucket
-                    raise tableschema.exceptions.StorageError(message)
-                return
-
-            # Remove from buckets
-            if bucket in self.__descriptors:
-                del self.__descriptors[bucket]
-
-            datastore_delete_url = \
-                "{}/datastore_delete".format(self.__base_endpoint)
-            params = {
-                'resource_id': bucket,
-                'force': True
-            }
-            self._make_ckan_request(datastore_delete_url, method='POST',
-                                    json=params)
+            if bucket not in existent and not ignore:
+                message = 'Bucket "%s" doesn\'t exist.' % bucket
+                raise tableschema.exceptions.StorageError(message)
 
-        # Invalidate cache
-        self.__bucket_cache = None
+        # Delete buckets
+        utils.run_concurrently(self.__delete_bucket,
+                               [b for b in buckets if b in existent],
+                               workers=self.__bucket_workers)
 
     def describe(self, bucket, descriptor=None):
 
@@ -175,6 +231,9 @@ class Storage(tableschema.Storage):
         # Get descriptor
         else:
             descriptor = self.__descriptors.get(bucket)
+            if descriptor is None:
+                descriptor = self.__cache.get(
+                    self.__get_cache_key('descriptor', bucket))
             if descriptor is None:
                 datastore_search_url = \
                     "{}/datastore_search".format(self.__base_endpoint)
@@ -188,71 +247,1052 @@ class Storage(tableschema.Storage):
                 fields = response['result']['fields']
                 descriptor = \
                     self.__mapper.datastore_fields_to_descriptor(fields)
+                self.__cache.set(self.__get_cache_key('descriptor', bucket),
+                                 descriptor)
 
         return descriptor
 
-    def iter(self, bucket):
+    def iter(self, bucket, paging='offset', page_size=None, key=None,
+             prefetch=0, fields=None, filters=None, q=None, sort=None,
+             limit=None, stream=False):
+        """Iterate over the rows of the bucket
+
+        Filtering, projection and sorting are done by the DataStore, so only
+        the requested rows and fields are downloaded and restored.
+
+        # Arguments
+            paging (str):
+                `offset` follows the `datastore_search` next page links.
+                `keyset` pages through `datastore_search_sql` ordered by
+                `key`, so reading each page costs the same regardless of its
+                position in the table. `dump` streams the whole table as CSV
+                from the `/datastore/dump` endpoint in a single response.
+            page_size (int):
+                number of records requested per page, or parsed per chunk
+                of a dump. Defaults to the DataStore default (100).
+            key (str/list):
+                unique, indexed fields used for `keyset` paging. Defaults to
+                the DataStore `_id` field.
+            prefetch (int):
+                number of pages fetched ahead by a background thread while
+                the rows of the current page are being consumed.
+            fields (str[]):
+                names of the fields included in the rows.
+            filters (dict):
+                field values the rows must match. A list of values matches
+                any of them.
+            q (str/dict):
+                full text query, for the whole row or by field. Not supported
+                with `keyset` paging.
+            sort (str):
+                comma separated fields to order by, e.g. `"name, id desc"`.
+                Not supported with `keyset` paging, which orders by `key`.
+            limit (int):
+                maximum number of rows.
+            stream (bool):
+                parse the records of `offset` and `keyset` pages as they are
+                received instead of loading whole pages, so memory doesn't
+                grow with `page_size`. It requires the `ijson` package.
+
+        """
+        schema, pages = self.__get_pages(
+            bucket, paging=paging, page_size=page_size, key=key,
+            prefetch=prefetch, fields=fields, filters=filters, q=q,
+            sort=sort, limit=limit, stream=stream)
+        restore_row = self.__mapper.compile_restore_row(schema)
+        rows = self.__iter_restored_rows(bucket, pages, restore_row)
+        if limit is not None:
+            rows = itertools.islice(rows, limit)
+        for row in rows:
+            yield row
+
+    def read(self, bucket, **options):
+        rows = list(self.iter(bucket, **options))
+        return rows
+
+    def iter_batches(self, bucket, batch_size=None, format='dict',
+                     **options):
+        """Iterate over batches of rows of the bucket as columns
+
+        Records are restored column by column, without a dict per row.
+        Columns of values which need no casting are made at once.
+
+        # Arguments
+            batch_size (int):
+                number of rows per batch. Defaults to the rows of each page.
+            format (str):
+                `dict` for dicts of lists, `numpy` for dicts of NumPy arrays
+                and `arrow` for `pyarrow.RecordBatch`es. Array types are
+                derived from the schema field types. Arrow columns of
+                objects and arrays hold JSON text.
+            **options:
+                `iter` options, e.g. `paging`, `fields` or `filters`.
+
+        """
+        return self.__iter_batches(bucket, batch_size, format, options)
+
+    def read_columnar(self, bucket, format='dict', **options):
+        """Read the rows of the bucket as columns
+
+        # Arguments
+            format (str):
+                `dict` for a dict of lists, `numpy` for a dict of NumPy arrays
+                and `arrow` for a `pyarrow.Table`.
+            **options: `iter_batches` options.
+
+        # Returns
+            dict/pyarrow.Table: columns by field name.
+
+        """
+        batch_size = options.pop('batch_size', None)
+        batches = list(self.__iter_batches(bucket, batch_size, format,
+                                           options, empty=True))
+        return columnar.concat_batches(format, batches)
+
+    def write(self, bucket, rows, method=None, as_generator=False,
+              batch_size=10000, max_batch_bytes=None, workers=None,
+              checkpoint=None, adaptive=False, calculate_record_count=False):
+        """Write rows to the bucket
+
+        Rows are sent to `datastore_upsert` in batches as they are consumed,
+        so memory usage doesn't grow with the size of the input.
+
+        # Arguments
+            method (str):
+                `datastore_upsert` method: `upsert`, `insert` or `update`.
+                Defaults to `insert` for buckets created or described here
+                without a primary key, which skips the key lookup per row,
+                and to `upsert` otherwise.
+            batch_size (int):
+                maximum number of rows per `datastore_upsert` request.
+                `None` disables the row limit.
+            max_batch_bytes (int):
+                maximum approximate size in bytes of the JSON encoded records
+                of a single `datastore_upsert` request.
+            workers (int):
+                number of threads sending batches concurrently. Rows are
+                converted and encoded while earlier batches are in flight.
+            checkpoint (str/callable/Checkpoint):
+                path of a file, or function, where the number of written
+                rows is saved as batches are written. A write with the same
+                checkpoint file skips the rows written by a failed one.
+            adaptive (bool/BatchSizer):
+                adapt the number of rows per batch, starting from
+                `batch_size`, to the time the DataStore takes to write them.
+                A batch rejected as too large (413) or timing out is split
+                and sent again in halves, except `insert` batches whose
+                response timed out, which may have been written. Pass a
+                `BatchSizer` to tune it.
+            calculate_record_count (bool):
+                update the record count the DataStore uses to estimate
+                search totals once all the batches are written, instead of
+                leaving it stale.
+
+        # Raises
+            BatchWriteError:
+                if batches failed. It holds the row ranges which were
+                written and which failed.
+
+        """
+        writer = self.write_aux(bucket, rows, method=method,
+                                batch_size=batch_size,
+                                max_batch_bytes=max_batch_bytes,
+                                workers=workers, checkpoint=checkpoint,
+                                adaptive=adaptive,
+                                calculate_record_count=calculate_record_count)
+        if as_generator:
+            return writer
+        else:
+            collections.deque(writer, maxlen=0)
+
+    def write_aux(self, bucket, rows, method=None,
+                  batch_size=10000, max_batch_bytes=None, workers=None,
+                  checkpoint=None, adaptive=False,
+                  calculate_record_count=False):
+        schema = tableschema.Schema(self.describe(bucket))
+        convert_row = self.__mapper.compile_convert_row(schema)
+        dumps = self.__json.dumps
+
+        def encode(row):
+            return dumps(convert_row(row))
+
+        for row in self.__write_items(bucket, rows, encode, method=method,
+                                      batch_size=batch_size,
+                                      max_batch_bytes=max_batch_bytes,
+                                      workers=workers, checkpoint=checkpoint,
+                                      adaptive=adaptive,
+                                      calculate_record_count=(
+                                          calculate_record_count)):
+            yield row
+
+    def write_batches(self, bucket, data, method=None, batch_size=10000,
+                      max_batch_bytes=None, workers=None, checkpoint=None,
+                      adaptive=False, calculate_record_count=False):
+        """Write columns to the bucket
+
+        Columns are converted a slice of `batch_size` rows at a time: nulls
+        and JSON values are converted per column and records are encoded
+        straight from them, without rows being built first.
+
+        # Arguments
+            data (object):
+                a `pandas.DataFrame`, a `pyarrow.Table` or `RecordBatch`, a
+                dict of column lists or NumPy arrays, or an iterable of
+                them. Columns are matched to fields by name.
+            batch_size (int):
+                maximum number of rows per `datastore_upsert` request.
+            method, max_batch_bytes, workers, checkpoint, adaptive,
+            calculate_record_count:
+                as for `write`.
+
+        # Raises
+            BatchWriteError:
+                if batches failed. It holds the row ranges which were
+                written and which failed.
+
+        """
         schema = tableschema.Schema(self.describe(bucket))
+        convert_columns = self.__mapper.compile_convert_columns(schema)
+        records = (record
+                   for columns in columnar.iter_column_slices(
+                       data, batch_size or 10000)
+                   for record in columnar.iter_records(
+                       convert_columns(columns)))
+        items = self.__write_items(bucket, records, self.__json.dumps,
+                                   method=method, batch_size=batch_size,
+                                   max_batch_bytes=max_batch_bytes,
+                                   workers=workers, checkpoint=checkpoint,
+                                   adaptive=adaptive,
+                                   calculate_record_count=(
+                                       calculate_record_count))
+        collections.deque(items, maxlen=0)
+
+    def write_buckets(self, data, **options):
+        """Write rows to several buckets
+
+        Up to `bucket_workers` buckets are written concurrently.
+
+        # Arguments
+            data (dict): rows by bucket name.
+            **options: `write` options, e.g. `method` or `batch_size`.
+
+        """
+        options.pop('as_generator', None)
+        utils.run_concurrently(
+            lambda item: self.write(item[0], item[1], **options),
+            list(data.items()), workers=self.__bucket_workers)
+
+    def sync(self, bucket, rows, key=None, index=None, delete=True,
+             batch_size=10000, workers=None):
+        """Write only the rows which changed since the last sync
+
+        Rows are compared by `key` to fingerprints of the bucket rows: new
+        and changed rows are sent to `datastore_upsert` and rows whose key
+        is missing are removed with `datastore_delete`. Fingerprints are
+        kept in the `index` file, or rebuilt by reading the bucket. If `key`
+        isn't the primary key of the bucket, changed rows are deleted and
+        inserted again.
+
+        # Arguments
+            rows (list[]):
+                all the rows the bucket should hold, as lists or dicts.
+            key (str/list):
+                fields identifying the rows. Defaults to the primary key.
+            index (str/FingerprintIndex):
+                path of the JSON file where fingerprints are kept between
+                syncs. If it's missing the bucket is read to rebuild them.
+            delete (bool):
+                delete the rows of the bucket whose key isn't in `rows`.
+            batch_size, workers:
+                as for `write`.
+
+        # Raises
+            BatchWriteError:
+                if batches failed. The index isn't saved, so the next sync
+                sends the failed rows again.
+
+        # Returns
+            dict: numbers of `inserted`, `updated`, `deleted` and
+            `unchanged` rows.
+
+        """
+        schema = tableschema.Schema(self.describe(bucket))
+        if key is None:
+            key = schema.primary_key
+        if isinstance(key, six.string_types):
+            key = [key]
+        if not key:
+            message = 'Syncing bucket "%s" requires a key.' % bucket
+            raise tableschema.exceptions.StorageError(message)
+        if not isinstance(index, FingerprintIndex):
+            index = FingerprintIndex(path=index)
+        fingerprint_row = sync.compile_fingerprint_row(
+            schema, key, self.__mapper.compile_convert_row(schema),
+            self.__json.dumps)
+
+        # Load or rebuild the fingerprints of the bucket rows
+        version = sync.get_version(schema, self.__json)
+        previous = index.load(bucket, version)
+        if previous is None:
+            previous = {}
+            for row in self.iter(bucket, fields=schema.field_names,
+                                 page_size=batch_size):
+                row_key, fingerprint, _ = fingerprint_row(row)
+                previous[row_key] = fingerprint
+
+        # Send new and changed rows
+        fingerprints = {}
+        stats = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
 
+        def iter_changed_records():
+            for row in rows:
+                row_key, fingerprint, record = fingerprint_row(row)
+                fingerprints[row_key] = fingerprint
+                previous_fingerprint = previous.get(row_key)
+                if previous_fingerprint == fingerprint:
+                    stats['unchanged'] += 1
+                    continue
+                if previous_fingerprint is None:
+                    stats['inserted'] += 1
+                else:
+                    stats['updated'] += 1
+                yield record
+
+        # Without a matching primary key the DataStore can't upsert, so
+        # changed rows are deleted and inserted again
+        records = iter_changed_records()
+        method = 'upsert'
+        if list(key) != schema.primary_key:
+            method = 'insert'
+            records = list(records)
+            updated = [row_key for row_key, fingerprint in fingerprints.items()
+                       if previous.get(row_key) not in [None, fingerprint]]
+            self.__delete_records(bucket, key,
+                                  [json.loads(row_key) for row_key in updated],
+                                  batch_size=batch_size, workers=workers)
+        items = self.__write_items(bucket, records, lambda record: record,
+                                   method=method, batch_size=batch_size,
+                                   workers=workers)
+        collections.deque(items, maxlen=0)
+
+        # Delete or keep rows missing from the input
+        removed = [row_key for row_key in previous
+                   if row_key not in fingerprints]
+        if delete:
+            self.__delete_records(bucket, key,
+                                  [json.loads(row_key) for row_key in removed],
+                                  batch_size=batch_size, workers=workers)
+            stats['deleted'] = len(removed)
+        else:
+            fingerprints.update((k, previous[k]) for k in removed)
+
+        index.save(bucket, version, fingerprints)
+        return stats
+
+    def replace(self, alias, rows, descriptor=None, staging_bucket=None,
+                defer_indexes=True, delete_previous=True, batch_size=10000,
+                max_batch_bytes=None, workers=None, adaptive=False):
+        """Replace the rows read through a DataStore alias
+
+        Rows are inserted into a fresh staging table and the `alias` is
+        moved to it once they are all written and indexed, so readers of the
+        alias see the previous rows until then instead of an empty or
+        partial table. Inserting into a table without indexes is also much
+        faster than upserting into an indexed one.
+
+        # Arguments
+            alias (str):
+                name of the DataStore alias the table is read by. It's
+                created if it doesn't exist.
+            rows (list[]):
+                all the rows of the new table.
+            descriptor (dict):
+                schema of the new table. Defaults to the schema of the table
+                behind the alias.
+            staging_bucket (str):
+                id of the resource the rows are loaded into. By default a new
+                resource of `dataset_id` is created, and deleted once it's
+                replaced in turn. Its table is deleted if the load fails.
+            defer_indexes (bool):
+                create the primary key and indexes after the rows are loaded.
+            delete_previous (bool):
+                delete the table the alias pointed to, and its resource if
+                it was created by `replace`.
+            batch_size, max_batch_bytes, workers, adaptive:
+                as for `write`.
+
+        # Raises
+            BatchWriteError:
+                if batches failed. The alias still points to the previous
+                table and the staging table is deleted.
+            StorageError:
+                if the deferred primary key or indexes can't be created,
+                e.g. for duplicate keys. The alias still points to the
+                previous table and the staging table is deleted.
+
+        # Returns
+            str: the bucket the alias points to.
+
+        """
+        previous = self.__get_alias_target(alias)
+        if descriptor is None:
+            if previous is None:
+                message = 'Alias "%s" doesn\'t exist.' % alias
+                raise tableschema.exceptions.StorageError(message)
+            descriptor = self.describe(previous)
+        tableschema.validate(descriptor)
+
+        # Load the rows into the staging table
+        staging_descriptor = descriptor
+        if defer_indexes:
+            staging_descriptor = {
+                k: v for k, v in descriptor.items()
+                if k not in ['primaryKey', 'foreignKeys', 'indexes']}
+        bucket = self.__create_staging_bucket(staging_bucket,
+                                              staging_descriptor, alias)
+        self.describe(bucket, descriptor)
+        datastore_create_url = \
+            "{}/datastore_create".format(self.__base_endpoint)
+        try:
+            self.write(bucket, rows, method='insert', batch_size=batch_size,
+                       max_batch_bytes=max_batch_bytes, workers=workers,
+                       adaptive=adaptive)
+
+            # Create the deferred indexes while the alias is untouched, as
+            # the rows were loaded without checking the primary key
+            if defer_indexes:
+                datastore_dict = \
+                    self.__mapper.descriptor_to_datastore_dict(descriptor,
+                                                               bucket)
+                self._make_ckan_request(datastore_create_url, method='POST',
+                                        json=datastore_dict)
+        except BaseException:
+            if staging_bucket is None:
+                self.__delete_staging_resource(bucket, alias)
+            else:
+                self.__delete_bucket(bucket)
+            raise
+
+        # Move the alias
+        if previous is not None:
+            self._make_ckan_request(datastore_create_url, method='POST',
+                                    json={'resource_id': previous,
+                                          'aliases': [],
+                                          'force': True})
+        self._make_ckan_request(datastore_create_url, method='POST',
+                                json={'resource_id': bucket,
+                                      'aliases': [alias],
+                                      'force': True})
+        self.__descriptors.pop(alias, None)
+        self.__cache.delete(self.__get_cache_key('descriptor', alias))
+        self.__update_cached_buckets(add=[alias])
+
+        if previous is not None and delete_previous:
+            self.__delete_bucket(previous)
+            self.__delete_staging_resource(previous, alias)
+        return bucket
+
+    # Private
+
+    def __create_bucket(self, bucket, descriptor):
+        '''Create the DataStore table of a bucket from a valid descriptor.
+        '''
+        self.__descriptors[bucket] = descriptor
+        datastore_dict = \
+            self.__mapper.descriptor_to_datastore_dict(descriptor, bucket)
+        datastore_create_url = \
+            "{}/datastore_create".format(self.__base_endpoint)
+        self._make_ckan_request(datastore_create_url, method='POST',
+                                json=datastore_dict)
+
+        # Update cache
+        self.__cache.delete(self.__get_cache_key('descriptor', bucket))
+        self.__update_cached_buckets(add=[bucket])
+
+    def __delete_bucket(self, bucket):
+        '''Delete the DataStore table of an existent bucket.
+        '''
+        self.__descriptors.pop(bucket, None)
+        datastore_delete_url = \
+            "{}/datastore_delete".format(self.__base_endpoint)
+        params = {
+            'resource_id': bucket,
+            'force': True
+        }
+        self._make_ckan_request(datastore_delete_url, method='POST',
+                                json=params)
+
+        # Update cache
+        self.__cache.delete(self.__get_cache_key('descriptor', bucket))
+        self.__update_cached_buckets(remove=[bucket])
+
+    def __get_alias_target(self, alias):
+        '''Return the bucket an alias points to, or `None` if it doesn't
+        exist.
+        '''
+        datastore_search_url = \
+            "{}/datastore_search".format(self.__base_endpoint)
+        params = {
+            'resource_id': '_table_metadata',
+            'filters': json.dumps({'name': alias})
+        }
+        response = self._make_ckan_request(datastore_search_url,
+                                           params=params)
+        records = response['result']['records']
+        if not records:
+            return None
+        if records[0].get('alias_of') is None:
+            message = 'Bucket "%s" is a table, not an alias.' % alias
+            raise tableschema.exceptions.StorageError(message)
+        return records[0]['alias_of']
+
+    def __create_staging_bucket(self, bucket, descriptor, name):
+        '''Create a staging table in the passed bucket, or in a new resource
+        of the dataset, and return its bucket.
+        '''
+        if bucket is not None:
+            self.create(bucket, descriptor, force=True)
+            return bucket
+        if self.__dataset_id is None:
+            message = 'A staging bucket or a dataset_id is required.'
+            raise tableschema.exceptions.StorageError(message)
+        datastore_dict = \
+            self.__mapper.descriptor_to_datastore_dict(descriptor, None)
+        del datastore_dict['resource_id']
+        # The resource is marked to be deleted once it's replaced
+        datastore_dict['resource'] = {'package_id': self.__dataset_id,
+                                      'name': name,
+                                      STAGING_ALIAS_KEY: name}
+        datastore_create_url = \
+            "{}/datastore_create".format(self.__base_endpoint)
+        response = self._make_ckan_request(datastore_create_url,
+                                           method='POST', json=datastore_dict)
+        bucket = response['result']['resource_id']
+        self.__update_cached_buckets(add=[bucket])
+        return bucket
+
+    def __delete_staging_resource(self, bucket, alias):
+        '''Delete the resource of a bucket if `replace` created it for the
+        alias, leaving other resources alone.
+        '''
+        resource_show_url = "{}/resource_show".format(self.__base_endpoint)
+        response = self._make_ckan_request(resource_show_url,
+                                           params=dict(id=bucket))
+        if response['result'].get(STAGING_ALIAS_KEY) != alias:
+            return
+        resource_delete_url = \
+            "{}/resource_delete".format(self.__base_endpoint)
+        self._make_ckan_request(resource_delete_url, method='POST',
+                                json={'id': bucket})
+        self.__descriptors.pop(bucket, None)
+        self.__cache.delete(self.__get_cache_key('descriptor', bucket))
+        self.__update_cached_buckets(remove=[bucket])
+
+    def __delete_records(self, bucket, key, keys, batch_size=10000,
+                         workers=None):
+        '''Delete the rows with the passed `key` values from the bucket. Rows
+        of a single field key are deleted `batch_size` keys at a time.
+        '''
+        datastore_delete_url = \
+            "{}/datastore_delete".format(self.__base_endpoint)
+        if len(key) == 1:
+            values = [row_key[0] for row_key in keys]
+            size = batch_size or len(values) or 1
+            filters = [{key[0]: values[start:start + size]}
+                       for start in range(0, len(values), size)]
+        else:
+            filters = [dict(zip(key, row_key)) for row_key in keys]
+
+        def delete(filters):
+            params = {
+                'resource_id': bucket,
+                'filters': filters,
+                'force': True
+            }
+            self._make_ckan_request(datastore_delete_url, method='POST',
+                                    json=params)
+
+        utils.run_concurrently(delete, filters, workers=workers)
+
+    def __get_pages(self, bucket, paging='offset', page_size=None, key=None,
+                    prefetch=0, fields=None, filters=None, q=None, sort=None,
+                    limit=None, stream=False):
+        '''Return the schema of the rows read from the bucket and an
+        iterator of pages of their records.
+        '''
+        if stream and ijson is None:
+            message = 'Streaming requires the "ijson" package'
+            raise ImportError(message)
+        descriptor = self.describe(bucket)
+        if fields is not None:
+            descriptor = self.__project_descriptor(descriptor, fields)
+        schema = tableschema.Schema(descriptor)
+        query = {'filters': filters, 'q': q, 'sort': sort}
+        if limit is not None:
+            page_size = min(page_size or limit, limit)
+        if paging == 'offset':
+            pages = self.__iter_offset_pages(bucket, schema, page_size,
+                                             fields, query, stream)
+        elif paging == 'keyset':
+            pages = self.__iter_keyset_pages(bucket, schema, page_size, key,
+                                             query, stream)
+        elif paging == 'dump':
+            pages = self.__iter_dump_pages(bucket, page_size, fields, query,
+                                           limit)
+        else:
+            message = 'Paging "%s" is not supported.' % paging
+            raise tableschema.exceptions.StorageError(message)
+        if prefetch:
+            pages = utils.iter_prefetched(pages, prefetch)
+        return schema, pages
+
+    def __iter_batches(self, bucket, batch_size, format, options,
+                       empty=False):
+        '''Yield column batches of the bucket rows, or a single empty batch
+        if there are no rows and `empty` is true.
+        '''
+        columnar.check_format(format)
+        schema, pages = self.__get_pages(bucket, **options)
+        restore_columns = self.__mapper.compile_restore_columns(schema,
+                                                                format)
+        pages = iter(pages)
+        if batch_size is not None:
+            pages = _iter_chunks(pages, batch_size)
+        limit = options.get('limit')
+        timer = _PhaseTimer(self.__metrics, bucket)
+        count = 0
+        try:
+            while limit is None or count < limit:
+                timer.start()
+                records = next(pages, None)
+                timer.stop('fetch', rows=len(records or []))
+                if records is None:
+                    break
+                if limit is not None:
+                    records = records[:limit - count]
+                count += len(records)
+                timer.start()
+                batch = restore_columns(records)
+                timer.stop('restore', rows=len(records))
+                yield batch
+            if not count and empty:
+                yield restore_columns([])
+        finally:
+            timer.report()
+
+    def __get_resources_for_dataset(self, dataset_id):
+        '''Get the list of resources of the passed dataset id.
+        '''
+        package_show_url = "{}/package_show".format(self.__base_endpoint)
+        response = self._make_ckan_request(package_show_url,
+                                           params=dict(id=dataset_id))
+
+        dataset = response['result']
+        return dataset['resources']
+
+    def __list_table_metadata(self):
+        '''List the DataStore tables, of the dataset if any.
+
+        The first page gives the total, then the other pages are fetched
+        concurrently by offset.
+        '''
+        params = {
+            'resource_id': '_table_metadata',
+            'limit': self.__bucket_page_size,
+            # Offset pages are only consistent in a stable order
+            'sort': 'name',
+        }
+        if self.__dataset_id is not None:
+            resources = self.__get_resources_for_dataset(self.__dataset_id)
+            filter_ids = [r['id'] for r in resources]
+            params.update({'filters': json.dumps({'name': filter_ids})})
+
+        datastore_search_url = \
+            "{}/datastore_search".format(self.__base_endpoint)
+
+        response = self._make_ckan_request(datastore_search_url, params=params)
+        result = response['result']
+        buckets = [r['name'] for r in result['records']]
+
+        # Follow the links if the total isn't known
+        total = result.get('total')
+        if total is None:
+            while result['records']:
+                next_url = self.__base_url + result['_links']['next']
+                result = self._make_ckan_request(next_url)['result']
+                buckets.extend(r['name'] for r in result['records'])
+            return buckets
+
+        # The server may return fewer rows than the limit
+        page_size = len(buckets)
+        if not page_size:
+            return buckets
+
+        def get_page(offset):
+            page_params = dict(params, offset=offset, limit=page_size)
+            response = self._make_ckan_request(datastore_search_url,
+                                               params=page_params)
+            return [r['name'] for r in response['result']['records']]
+
+        pages = utils.run_concurrently(
+            get_page, range(page_size, total, page_size),
+            workers=self.__bucket_workers or self.__pool_size)
+        for page in pages:
+            buckets.extend(page)
+        return buckets
+
+    def __get_cache_key(self, *names):
+        return ':'.join((self.__base_url, self.__dataset_id or '') + names)
+
+    def __update_cached_buckets(self, add=(), remove=()):
+        '''Add and remove buckets from the cached bucket list, if any.
+        '''
+        key = self.__get_cache_key('buckets')
+        with self.__cache_lock:
+            buckets = self.__cache.get(key)
+            if buckets is not None:
+                buckets = [b for b in buckets if b not in remove]
+                buckets.extend(b for b in add if b not in buckets)
+                self.__cache.set(key, buckets)
+
+    def __project_descriptor(self, descriptor, fields):
+        '''Return a descriptor with only the passed `fields`.
+        '''
+        descriptor_fields = {f['name']: f for f in descriptor['fields']}
+        projected = []
+        for name in fields:
+            if name not in descriptor_fields:
+                message = 'Field "%s" doesn\'t exist.' % name
+                raise tableschema.exceptions.StorageError(message)
+            projected.append(descriptor_fields[name])
+        projected_descriptor = {k: v for k, v in descriptor.items()
+                                if k not in ['primaryKey', 'foreignKeys']}
+        projected_descriptor['fields'] = projected
+        return projected_descriptor
+
+    def __iter_offset_pages(self, bucket, schema, page_size, fields, query,
+                            stream=False):
+        '''Yield pages of records following the `datastore_search` links.
+        Streamed pages are requested by offset, as their links are only
+        known once they are parsed.
+        '''
         datastore_search_url = \
             "{}/datastore_search".format(self.__base_endpoint)
         params = {
             'resource_id': bucket
         }
+        if page_size is not None:
+            params['limit'] = page_size
+        if fields is not None:
+            params['fields'] = ','.join(schema.field_names)
+        params.update(self.__get_query_params(query))
+        if stream:
+            offset = 0
+            while True:
+                count = 0
+                for records in self.__iter_streamed_records(
+                        datastore_search_url, dict(params, offset=offset)):
+                    count += len(records)
+                    yield records
+                if not count:
+                    break
+                offset += count
+            return
         response = self._make_ckan_request(datastore_search_url,
                                            params=params)
         while response['result']['records']:
-            for row in response['result']['records']:
-                row = self.__mapper.restore_row(row, schema=schema)
-                yield row
+            yield response['result']['records']
             next_url = self.__base_url + response['result']['_links']['next']
             response = self._make_ckan_request(next_url)
 
-    def read(self, bucket):
-        rows = list(self.iter(bucket))
-        return rows
+    def __iter_keyset_pages(self, bucket, schema, page_size, key, query,
+                            stream=False):
+        '''Yield pages of records from `datastore_search_sql` where the `key`
+        is greater than the key of the last record of the previous page.
+        '''
+        for name in ['q', 'sort']:
+            if query[name] is not None:
+                message = '"%s" is not supported with keyset paging.' % name
+                raise tableschema.exceptions.StorageError(message)
+        if page_size is None:
+            page_size = 100
+        if key is None:
+            key = ['_id']
+        elif isinstance(key, six.string_types):
+            key = [key]
+        columns = key + [f.name for f in schema.fields if f.name not in key]
+        select = 'SELECT {} FROM {}'.format(
+            ', '.join(utils.quote_identifier(c) for c in columns),
+            utils.quote_identifier(bucket))
+        order = ' ORDER BY {} LIMIT {}'.format(
+            ', '.join(utils.quote_identifier(k) for k in key), page_size)
+        conditions = []
+        for name, value in sorted((query['filters'] or {}).items()):
+            if isinstance(value, list):
+                conditions.append('{} IN ({})'.format(
+                    utils.quote_identifier(name),
+                    ', '.join(utils.quote_literal(v) for v in value)))
+            else:
+                conditions.append('{} = {}'.format(
+                    utils.quote_identifier(name), utils.quote_literal(value)))
+        datastore_search_sql_url = \
+            "{}/datastore_search_sql".format(self.__base_endpoint)
+        last = None
+        while True:
+            where = list(conditions)
+            if last is not None:
+                where.append('({}) > ({})'.format(
+                    ', '.join(utils.quote_identifier(k) for k in key),
+                    ', '.join(utils.quote_literal(last[k]) for k in key)))
+            sql = select
+            if where:
+                sql += ' WHERE ' + ' AND '.join(where)
+            params = {'sql': sql + order}
+            if stream:
+                pages = self.__iter_streamed_records(
+                    datastore_search_sql_url, params)
+            else:
+                response = self._make_ckan_request(
+                    datastore_search_sql_url, params=params)
+                pages = [response['result']['records']]
+            count = 0
+            for records in pages:
+                if records:
+                    count += len(records)
+                    last = records[-1]
+                    yield records
+            if count < page_size:
+                break
 
-    def write(self, bucket, rows, method="upsert", as_generator=False):
-        if as_generator:
-            return self.write_aux(bucket, rows, method=method)
-        else:
-            collections.deque(self.write_aux(bucket, rows, method=method), maxlen=0)
+    def __iter_dump_pages(self, bucket, page_size, fields, query, limit):
+        '''Yield pages of records parsed from the CSV `/datastore/dump`
+        response as it is received.
+        '''
+        if page_size is None:
+            page_size = 100
+        datastore_dump_url = \
+            "{}/datastore/dump/{}".format(self.__base_url, bucket)
+        params = {
+            'format': 'csv'
+        }
+        if fields is not None:
+            params['fields'] = ','.join(fields)
+        if limit is not None:
+            params['limit'] = limit
+        params.update(self.__get_query_params(query))
+        response = self._open_ckan_stream(datastore_dump_url, params=params)
+        with contextlib.closing(response):
+            stream = io.TextIOWrapper(response.raw, encoding='utf-8-sig',
+                                      newline='')
+            records = csv.DictReader(stream)
+            while True:
+                page = list(itertools.islice(records, page_size))
+                if not page:
+                    break
+                yield page
 
-    def write_aux(self, bucket, rows, method="upsert"):
-        schema = tableschema.Schema(self.describe(bucket))
-        datastore_upsert_url = \
-            "{}/datastore_upsert".format(self.__base_endpoint)
-        records = []
-        for r in rows:
-            records.append(self.__mapper.convert_row(r, schema))
-            yield r
+    def __iter_streamed_records(self, url, params):
+        '''Yield chunks of the records of a search response, parsed as the
+        response body is received.
+        '''
+        response = self._open_ckan_stream(url, params=params)
+        with contextlib.closing(response):
+            records = ijson.items(response.raw, 'result.records.item',
+                                  use_float=True)
+            while True:
+                chunk = list(itertools.islice(records, STREAM_CHUNK_SIZE))
+                if not chunk:
+                    break
+                yield chunk
+
+    def __get_query_params(self, query):
+        '''Return request params for the `filters`, `q` and `sort` query.
+        '''
+        params = {}
+        if query['filters'] is not None:
+            params['filters'] = json.dumps(query['filters'])
+        if query['q'] is not None:
+            q = query['q']
+            params['q'] = q if isinstance(q, six.string_types) \
+                else json.dumps(q)
+        if query['sort'] is not None:
+            params['sort'] = query['sort']
+        return params
+
+    def __iter_restored_rows(self, bucket, pages, restore_row):
+        '''Yield rows restored from pages of records, timing both phases.
+        '''
+        timer = _PhaseTimer(self.__metrics, bucket)
+        pages = iter(pages)
+        try:
+            while True:
+                timer.start()
+                records = next(pages, None)
+                timer.stop('fetch', rows=len(records or []))
+                if records is None:
+                    break
+                timer.start()
+                rows = [restore_row(record) for record in records]
+                timer.stop('restore', rows=len(rows))
+                for row in rows:
+                    yield row
+        finally:
+            timer.report()
+
+    def __write_items(self, bucket, items, encode, method=None,
+                      batch_size=10000, max_batch_bytes=None, workers=None,
+                      checkpoint=None, adaptive=False,
+                      calculate_record_count=False):
+        '''Encode items to JSON records and send them to `datastore_upsert`
+        in batches, yielding the items as they are consumed.
+        '''
+        if method is None:
+            # Remote descriptors don't tell the primary key, so only rows of
+            # buckets known to have none are appended
+            descriptor = self.__descriptors.get(bucket)
+            method = 'upsert'
+            if descriptor is not None and not descriptor.get('primaryKey'):
+                method = 'insert'
         params = {
             'resource_id': bucket,
             'method': method,
-            'force': True,
-            'records': records
+            'force': True
         }
-        self._make_ckan_request(datastore_upsert_url, method='POST',
-                                json=params)
+        if isinstance(checkpoint, six.string_types):
+            checkpoint = Checkpoint(path=checkpoint)
+        elif callable(checkpoint):
+            checkpoint = Checkpoint(callback=checkpoint)
+        start = 0
+        on_commit = None
+        if checkpoint is not None:
+            start = checkpoint.load(bucket)
+            on_commit = functools.partial(checkpoint.save, bucket)
+        sizer = None
+        if isinstance(adaptive, BatchSizer):
+            sizer = adaptive
+        elif adaptive:
+            sizer = BatchSizer(size=batch_size or 10000)
+        send = functools.partial(self.__send_batch, sizer=sizer)
+        batches = BatchWriter(send, workers=workers,
+                              start=start, on_commit=on_commit)
+        timer = _PhaseTimer(self.__metrics, bucket)
+        records = []
+        records_bytes = 0
+        try:
+            for index, item in enumerate(items):
+                # Skip items written before resuming
+                if index < start:
+                    yield item
+                    continue
+                timer.start()
+                record = encode(item)
+                timer.stop('convert')
+                # Account for the separator between records
+                record_bytes = len(record) + 2
+                if max_batch_bytes is not None and records and \
+                        records_bytes + record_bytes > max_batch_bytes:
+                    self.__submit_batch(batches, timer, params, start, records)
+                    start += len(records)
+                    records = []
+                    records_bytes = 0
+                records.append(record)
+                records_bytes += record_bytes
+                yield item
+                if sizer is not None:
+                    batch_size = sizer.size
+                if batch_size is not None and len(records) >= batch_size:
+                    self.__submit_batch(batches, timer, params, start, records)
+                    start += len(records)
+                    records = []
+                    records_bytes = 0
+            if records:
+                self.__submit_batch(batches, timer, params, start, records)
+        except BaseException:
+            batches.close(raise_errors=False)
+            raise
+        timer.start()
+        batches.close()
+        if calculate_record_count:
+            self.__send_batch(Batch.encode(
+                start, dict(params, calculate_record_count=True), [],
+                self.__json.dumps))
+        timer.stop('send', rows=0)
+        timer.report()
+        if checkpoint is not None:
+            checkpoint.finish()
 
-    # Private
+    def __submit_batch(self, batches, timer, params, start, records):
+        '''Encode and submit a batch of JSON encoded records.
+        '''
+        batch = Batch.encode(start, params, records, self.__json.dumps)
+        timer.start()
+        batches.submit(batch)
+        timer.stop('send', rows=len(records))
 
-    def __get_resource_ids_for_dataset(self, dataset_id):
-        '''Get a list of resource ids for the passed dataset id.
+    def __send_batch(self, batch, sizer=None):
+        '''Send an encoded batch of records to `datastore_upsert`. With a
+        `sizer`, a batch too large to be sent is split in halves.
         '''
-        package_show_url = "{}/package_show".format(self.__base_endpoint)
-        response = self._make_ckan_request(package_show_url,
-                                           params=dict(id=dataset_id))
+        datastore_upsert_url = \
+            "{}/datastore_upsert".format(self.__base_endpoint)
+        # Inserting twice duplicates rows, so only upserts are retried
+        idempotent = batch.params is None or \
+            batch.params.get('method') != 'insert'
+        headers = {'Content-Type': 'application/json'}
+        body = utils.compress_body(batch.body, headers, self.__compress)
+        start = timeit.default_timer()
+        try:
+            self._make_ckan_request(
+                datastore_upsert_url, method='POST', data=body,
+                headers=headers, idempotent=idempotent)
+        except (RequestError, requests.Timeout) as exception:
+            # A read timeout may come after the rows were written, so only
+            # batches which can be sent twice are split after one
+            if isinstance(exception, requests.Timeout):
+                too_large = idempotent or \
+                    isinstance(exception, requests.ConnectTimeout)
+            else:
+                too_large = exception.response.status_code == 413
+            if sizer is None or not too_large or \
+                    batch.records is None or len(batch.records) < 2:
+                raise
+            log.warning('Splitting rows {}-{}: {}'.format(
+                batch.start, batch.stop - 1, exception))
+            sizer.shrink()
+            for half in batch.split():
+                self.__send_batch(half, sizer=sizer)
+            return
+        if sizer is not None:
+            sizer.record(batch.stop - batch.start,
+                         timeit.default_timer() - start)
 
-        dataset = response['result']
-        resources = dataset['resources']
-        resource_ids = [r['id'] for r in resources]
-        return resource_ids
+    def _open_ckan_stream(self, url, **kwargs):
+        try:
+            return utils.make_ckan_stream(url,
+                                          api_key=self.__api_key,
+                                          session=self.__session,
+                                          metrics=self.__metrics,
+                                          retries=self.__retries,
+                                          backoff_factor=self.__backoff_factor,
+                                          **self.__get_request_options(kwargs))
+        except requests.HTTPError as exception:
+            msg = 'CKAN returned an error: ' + str(exception)
+            raise RequestError(msg, exception.response)
 
     def _make_ckan_request(self, datastore_url, **kwargs):
-        response = utils.make_ckan_request(datastore_url,
-                                           api_key=self.__api_key,
-                                           **kwargs)
+        try:
+            response = utils.make_ckan_request(
+                datastore_url,
+                api_key=self.__api_key,
+                session=self.__session,
+                metrics=self.__metrics,
+                retries=self.__retries,
+                backoff_factor=self.__backoff_factor,
+                loads=self.__json.loads,
+                **self.__get_request_options(kwargs))
+        except requests.HTTPError as exception:
+            msg = 'CKAN returned an error: ' + str(exception)
+            raise RequestError(msg, exception.response)
 
         ckan_error = utils.get_ckan_error(response)
         if ckan_error:
@@ -260,3 +1300,57 @@ class Storage(tableschema.Storage):
             raise tableschema.exceptions.StorageError(msg)
 
         return response
+
+    def __get_request_options(self, kwargs):
+        if self.__timeout is not None:
+            kwargs.setdefault('timeout', self.__timeout)
+        return kwargs
+
+
+# Internal
+
+# Number of streamed records restored at once
+STREAM_CHUNK_SIZE = 100
+
+# Resource field marking the resources created by `replace` for an alias
+STAGING_ALIAS_KEY = 'datastore_replace_alias'
+
+
+def _iter_chunks(pages, size):
+    '''Yield lists of `size` records from pages of any size.
+    '''
+    chunk = []
+    for records in pages:
+        chunk.extend(records)
+        start = 0
+        while len(chunk) - start >= size:
+            yield chunk[start:start + size]
+            start += size
+        del chunk[:start]
+    if chunk:
+        yield chunk
+
+
+class _PhaseTimer(object):
+    '''Accumulate the time spent in phases and report it to `metrics`.
+    '''
+
+    def __init__(self, metrics, bucket):
+        self.__metrics = metrics
+        self.__bucket = bucket
+        self.__phases = collections.OrderedDict()
+        self.__start = None
+
+    def start(self):
+        if self.__metrics is not None:
+            self.__start = timeit.default_timer()
+
+    def stop(self, phase, rows=1):
+        if self.__metrics is not None:
+            seconds, count = self.__phases.get(phase, (0, 0))
+            seconds += timeit.default_timer() - self.__start
+            self.__phases[phase] = (seconds, count + rows)
+
+    def report(self):
+        for phase, (seconds, rows) in self.__phases.items():
+            self.__metrics.on_phase(phase, self.__bucket, seconds, rows)
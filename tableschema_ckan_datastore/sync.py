@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import os
+import json
+import hashlib
+import tableschema
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Module API
+
+class FingerprintIndex(object):
+    """Fingerprints of the rows of a bucket by key, kept between syncs
+
+    A fingerprint is a short hash of the JSON record of a row, so a sync
+    finds the rows which changed without reading the bucket. The index is
+    rebuilt from the bucket when the file is missing or was made for
+    another schema or JSON backend.
+
+    # Arguments
+        path (str):
+            JSON file where the fingerprints are saved after every sync.
+            If `None` they are rebuilt by each sync.
+
+    """
+
+    def __init__(self, path=None):
+        self.__path = path
+
+    def load(self, bucket, version):
+        '''Return the fingerprints by key of the `bucket` rows, or `None` if
+        there are none saved for this `version` of the records.
+        '''
+        if self.__path is None or not os.path.exists(self.__path):
+            return None
+        with io.open(self.__path, encoding='utf-8') as file:
+            index = json.load(file)
+        if index['bucket'] != bucket:
+            message = 'Fingerprint index "%s" is for bucket "%s".' % (
+                self.__path, index['bucket'])
+            raise tableschema.exceptions.StorageError(message)
+        if index['version'] != version:
+            log.info('Rebuilding fingerprint index "{}" of another schema'
+                     .format(self.__path))
+            return None
+        return index['fingerprints']
+
+    def save(self, bucket, version, fingerprints):
+        '''Save the fingerprints by key of the `bucket` rows.
+        '''
+        if self.__path is None:
+            return
+        index = {'bucket': bucket, 'version': version,
+                 'fingerprints': fingerprints}
+        temp_path = self.__path + '.tmp'
+        with io.open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(json.dumps(index, ensure_ascii=False))
+        _replace(temp_path, self.__path)
+
+
+def get_version(schema, backend):
+    '''Return an identifier of the schema and JSON backend the fingerprints
+    are computed with, as both change the encoded records.
+    '''
+    descriptor = json.dumps(schema.descriptor, sort_keys=True)
+    return _hash('{}:{}'.format(backend.name, descriptor).encode('utf-8'))
+
+
+def compile_fingerprint_row(schema, key, convert_row, dumps):
+    '''Return a function returning the key, fingerprint and JSON record of a
+    row. Rows are cast first, so rows of text and rows read back from the
+    DataStore give the same fingerprint.
+    '''
+    names = schema.field_names
+
+    def fingerprint_row(row):
+        if isinstance(row, dict):
+            row = [row.get(name) for name in names]
+        record = convert_row(schema.cast_row(row))
+        encoded = dumps(record)
+        row_key = dumps([record[name] for name in key]).decode('utf-8')
+        return row_key, _hash(encoded), encoded
+
+    return fingerprint_row
+
+
+# Internal
+
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _hash(data):
+    return hashlib.sha1(data).hexdigest()[:16]
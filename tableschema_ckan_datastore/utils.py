@@ -1,32 +1,223 @@
 import os
-import json
+import six
+import time
+import zlib
+import random
+import timeit
 import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from six.moves.urllib.parse import urlparse
 
 import logging
 log = logging.getLogger(__name__)
 
 
-def make_ckan_request(url, method='GET', headers=None, api_key=None, **kwargs):
-    '''Make a CKAN API request to `url` and return the json response. **kwargs
-    are passed to requests.request()'''
+def make_session(pool_size=10, keep_alive=True, adapter=None):
+    '''Return a requests.Session pooling up to `pool_size` connections per
+    host. If passed, the transport `adapter` is mounted instead of a default
+    HTTPAdapter.'''
+    session = requests.Session()
+    if adapter is None:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
 
-    if headers is None:
-        headers = {}
 
-    if api_key:
-        if api_key.startswith('env:'):
-            api_key = os.environ.get(api_key[4:])
-        headers.update({'Authorization': api_key})
+def make_ckan_request(url, method='GET', headers=None, api_key=None,
+                      session=None, metrics=None, retries=0,
+                      backoff_factor=0.5, idempotent=None, loads=None,
+                      **kwargs):
+    '''Make a CKAN API request to `url` and return the json response, decoded
+    by `loads` if passed. The request is sent through `session` if passed
+    and reported to `metrics`. Transient failures are retried up to
+    `retries` times, see `send_ckan_request_with_retries`. Raises
+    requests.HTTPError for error statuses without a json response.
+    **kwargs are passed to requests.request()'''
 
-    response = requests.request(method=method, url=url, headers=headers,
-                                allow_redirects=True, **kwargs)
+    start = timeit.default_timer()
+    try:
+        response, attempts = send_ckan_request_with_retries(
+            url, method=method, headers=headers, api_key=api_key,
+            session=session, retries=retries, backoff_factor=backoff_factor,
+            idempotent=idempotent, **kwargs)
+    except requests.RequestException as exception:
+        report_ckan_request(metrics, url, method, None, start, exception,
+                            retries=getattr(exception, 'retries', 0))
+        raise
 
     try:
-        return response.json()
-    except json.decoder.JSONDecodeError:
+        if loads is not None:
+            result = loads(response.content)
+        else:
+            result = response.json()
+    except ValueError as exception:
+        report_ckan_request(metrics, url, method, response, start, exception,
+                            retries=attempts)
+        if response.status_code >= 400:
+            response.raise_for_status()
         log.error('Expected JSON in response from: {}'.format(url))
         raise
 
+    report_ckan_request(metrics, url, method, response, start,
+                        get_ckan_error(result), retries=attempts)
+    return result
+
+
+def make_ckan_stream(url, method='GET', headers=None, api_key=None,
+                     session=None, metrics=None, retries=0,
+                     backoff_factor=0.5, **kwargs):
+    '''Make a CKAN request to `url` and return the requests.Response with
+    its body not yet read. Raises requests.HTTPError for error statuses.'''
+
+    start = timeit.default_timer()
+    attempts = 0
+    try:
+        response, attempts = send_ckan_request_with_retries(
+            url, method=method, headers=headers, api_key=api_key,
+            session=session, retries=retries, backoff_factor=backoff_factor,
+            stream=True, **kwargs)
+        response.raise_for_status()
+    except requests.RequestException as exception:
+        report_ckan_request(metrics, url, method,
+                            getattr(exception, 'response', None), start,
+                            exception, stream=True,
+                            retries=getattr(exception, 'retries', attempts))
+        raise
+    report_ckan_request(metrics, url, method, response, start, stream=True,
+                        retries=attempts)
+    response.raw.decode_content = True
+    # Keep the body readable as a file at its end, e.g. by io.TextIOWrapper
+    response.raw.auto_close = False
+    return response
+
+
+def send_ckan_request_with_retries(url, method='GET', retries=0,
+                                   backoff_factor=0.5, idempotent=None,
+                                   **kwargs):
+    '''Send a CKAN request to `url` and return `(response, retries)`.
+
+    Connection errors, timeouts and the 429, 502, 503 and 504 statuses are
+    retried up to `retries` times, waiting `backoff_factor * 2 ** retry`
+    seconds with jitter, or as long as a `Retry-After` header asks for.
+    Only idempotent requests are retried: GET requests by default, others
+    if `idempotent` is true. A raised exception holds the number of retries
+    as its `retries` attribute.'''
+
+    if idempotent is None:
+        idempotent = method.upper() in ['GET', 'HEAD', 'OPTIONS']
+    if not idempotent:
+        retries = 0
+
+    attempt = 0
+    while True:
+        delay = None
+        try:
+            response = send_ckan_request(url, method=method, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as exception:
+            if attempt >= retries:
+                exception.retries = attempt
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES or \
+                    attempt >= retries:
+                return response, attempt
+            delay = get_retry_after(response)
+            response.close()
+        if delay is None:
+            delay = get_backoff(backoff_factor, attempt)
+        attempt += 1
+        log.warning('Retrying {} {} ({}/{}) in {:.2f}s'.format(
+            method, url, attempt, retries, delay))
+        time.sleep(delay)
+
+
+def send_ckan_request(url, method='GET', headers=None, api_key=None,
+                      session=None, **kwargs):
+    '''Send a CKAN request to `url` and return the requests.Response.'''
+
+    headers = make_headers(headers=headers, api_key=api_key)
+
+    if session is None:
+        session = requests
+    return session.request(method=method, url=url, headers=headers,
+                           allow_redirects=True, **kwargs)
+
+
+def report_ckan_request(metrics, url, method, response, start, error=None,
+                        stream=False, retries=0):
+    '''Report a CKAN request started at `start` to `metrics`, if any.'''
+
+    if metrics is None:
+        return
+    bytes_sent = 0
+    bytes_received = None
+    status = None
+    if response is not None:
+        body = response.request.body
+        bytes_sent = len(body) if isinstance(body, (six.binary_type, six.text_type)) else 0
+        if not stream:
+            bytes_received = len(response.content)
+        status = response.status_code
+    path = urlparse(url).path.rstrip('/').split('/')
+    action = path[-1]
+    if len(path) > 2 and path[-2] == 'dump':
+        action = 'datastore_dump'
+    metrics.on_request(action=action, method=method, url=url, status=status,
+                       bytes_sent=bytes_sent, bytes_received=bytes_received,
+                       seconds=timeit.default_timer() - start,
+                       retries=retries, error=error)
+
+
+def compress_body(body, headers, compress):
+    '''Return `body` bytes gzipped at the `compress` level, or level
+    COMPRESS_LEVEL if it's `True`, and add their Content-Encoding to
+    `headers`. Bodies smaller than COMPRESS_MIN_BYTES are returned as they
+    are.'''
+    if not compress or len(body) < COMPRESS_MIN_BYTES:
+        return body
+    level = COMPRESS_LEVEL if compress is True else compress
+    # A gzip header and trailer are written with 16 added to the wbits
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    headers['Content-Encoding'] = 'gzip'
+    return compressor.compress(body) + compressor.flush()
+
+
+def get_backoff(backoff_factor, attempt):
+    '''Return the seconds to wait before retry number `attempt` + 1: the
+    exponential delay, capped to MAX_BACKOFF, with a random jitter of 50%.'''
+    delay = min(backoff_factor * 2 ** attempt, MAX_BACKOFF)
+    return delay * random.uniform(0.5, 1.5)
+
+
+def get_retry_after(response):
+    '''Return the seconds in the `Retry-After` header of `response`, if
+    any, capped to MAX_BACKOFF.'''
+    try:
+        delay = float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+    return min(max(delay, 0), MAX_BACKOFF)
+
+
+def make_headers(headers=None, api_key=None):
+    '''Return request headers with the CKAN `api_key` authorization. An
+    `api_key` in the format `env:CKAN_API_KEY_NAME` is read from the env.'''
+
+    if headers is None:
+        headers = {}
+
+    if api_key and api_key.startswith('env:'):
+        api_key = os.environ.get(api_key[4:])
+    if api_key:
+        headers.update({'Authorization': api_key})
+
+    return headers
+
 
 def get_ckan_error(response):
     '''Return the error from a ckan json response, or None.'''
@@ -38,3 +229,83 @@ def get_ckan_error(response):
         ckan_error = response
 
     return ckan_error
+
+
+def quote_identifier(name):
+    '''Return `name` quoted as a PostgreSQL identifier.'''
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def quote_literal(value):
+    '''Return a JSON value from a DataStore record as a PostgreSQL literal.'''
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, six.integer_types + (float,)):
+        return repr(value)
+    return "'{}'".format(six.text_type(value).replace("'", "''"))
+
+
+def run_concurrently(function, items, workers=None):
+    '''Call `function` with each of `items` from up to `workers` threads and
+    return the results in order. The first exception is raised once all
+    the calls are finished.'''
+    items = list(items)
+    if workers is None or workers < 2 or len(items) < 2:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(workers, len(items))) as executor:
+        futures = [executor.submit(function, item) for item in items]
+    return [future.result() for future in futures]
+
+
+def iter_prefetched(iterator, depth):
+    '''Yield the items of `iterator` while a background thread consumes up to
+    `depth` items ahead of the caller.'''
+    queue = six.moves.queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except six.moves.queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+            put((_DONE, None))
+        except Exception as exception:
+            put((None, exception))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, exception = queue.get()
+            if exception is not None:
+                raise exception
+            if item is _DONE:
+                break
+            yield item
+    finally:
+        stopped.set()
+
+
+# Internal
+
+RETRY_STATUSES = (429, 502, 503, 504)
+MAX_BACKOFF = 60
+# JSON records compress well even at the fastest level
+COMPRESS_LEVEL = 1
+COMPRESS_MIN_BYTES = 1024
+_DONE = object()
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import os
+import json
+import threading
+import tableschema
+from concurrent.futures import ThreadPoolExecutor
+from .json_backend import get_backend
+
+import logging
+log = logging.getLogger(__name__)
+
+
+# Module API
+
+class BatchWriteError(tableschema.exceptions.StorageError):
+    """Some batches of a write failed
+
+    # Arguments
+        committed (list):
+            sorted `(start, stop)` row ranges which were written.
+        failed (list):
+            sorted `(start, stop, error)` row ranges which were not written.
+        commit_errors (list):
+            `(rows, error)` errors of the commit callback, e.g. saving a
+            checkpoint, after `rows` rows were written.
+
+    """
+
+    def __init__(self, committed, failed, commit_errors=()):
+        self.committed = committed
+        self.failed = failed
+        self.commit_errors = list(commit_errors)
+        written = sum(stop - start for start, stop in committed)
+        if failed:
+            ranges = ', '.join(
+                '{}-{} ({})'.format(start, stop - 1, error)
+                for start, stop, error in failed)
+            message = 'Failed to write rows {}. {} rows were written.'.format(
+                ranges, written)
+        else:
+            message = '{} rows were written.'.format(written)
+        if self.commit_errors:
+            message = 'Failed to commit {}. {}'.format(', '.join(
+                '{} rows ({})'.format(rows, error)
+                for rows, error in self.commit_errors), message)
+        super(BatchWriteError, self).__init__(message)
+
+
+class Batch(object):
+    """Encoded records of rows `start` to `stop` (exclusive)
+
+    A batch created with its request `params` and JSON encoded `records`
+    can be split to be sent in smaller requests. The params are encoded by
+    `dumps`, the default JSON backend if `None`.
+
+    """
+
+    def __init__(self, start, stop, body, params=None, records=None,
+                 dumps=None):
+        self.start = start
+        self.stop = stop
+        self.body = body
+        self.params = params
+        self.records = records
+        self.dumps = dumps
+
+    @classmethod
+    def encode(cls, start, params, records, dumps=None):
+        '''Return a splittable batch of JSON encoded `records` from `start`.
+        '''
+        return cls(start, start + len(records),
+                   encode_records(params, records, dumps), params, records,
+                   dumps)
+
+    def split(self):
+        '''Return two batches holding the two halves of the records.
+        '''
+        if self.records is None or len(self.records) < 2:
+            raise ValueError('Batch of rows {}-{} can\'t be split'.format(
+                self.start, self.stop - 1))
+        middle = len(self.records) // 2
+        return [
+            Batch.encode(self.start, self.params, self.records[:middle],
+                         self.dumps),
+            Batch.encode(self.start + middle, self.params,
+                         self.records[middle:], self.dumps),
+        ]
+
+
+class BatchSizer(object):
+    """Adapt the number of rows per batch to the DataStore
+
+    The size grows while batches are sent faster than `target_seconds` and
+    shrinks when they are slower, so it settles near the largest batch the
+    server handles in that time. It's halved when a batch is rejected as
+    too large or times out.
+
+    # Arguments
+        size (int): initial number of rows per batch.
+        minimum (int): smallest number of rows per batch.
+        maximum (int):
+            largest number of rows per batch. Defaults to ten times `size`.
+        target_seconds (float): expected time to send a batch.
+        growth (float): factor the size is multiplied by to grow.
+
+    """
+
+    def __init__(self, size=10000, minimum=1, maximum=None,
+                 target_seconds=2.0, growth=1.25):
+        if maximum is None:
+            maximum = size * 10
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_seconds = target_seconds
+        self.growth = growth
+        self.__size = min(max(size, minimum), maximum)
+        self.__lock = threading.Lock()
+
+    @property
+    def size(self):
+        return int(self.__size)
+
+    def record(self, rows, seconds):
+        '''Adapt the size to a batch of `rows` sent in `seconds`.
+        '''
+        with self.__lock:
+            # Ignore small batches, e.g. the last one or halves of a split
+            if rows < self.size // 2:
+                return
+            if seconds < self.target_seconds:
+                size = self.__size * self.growth
+            else:
+                size = self.__size * self.target_seconds / seconds
+            self.__size = min(max(size, self.minimum), self.maximum)
+
+    def shrink(self):
+        '''Halve the size after a batch was too large to be sent.
+        '''
+        with self.__lock:
+            self.__size = max(self.__size / 2, self.minimum)
+
+
+class BatchWriter(object):
+    """Send batches to the DataStore inline or from a pool of threads
+
+    # Arguments
+        send (callable):
+            called with a `Batch` to send it to the DataStore.
+        workers (int):
+            number of threads sending batches. If `None` batches are sent
+            inline by `submit`.
+        max_pending (int):
+            number of batches queued or in flight before `submit` blocks.
+            Defaults to twice the number of workers.
+        start (int):
+            first row of the first batch.
+        on_commit (callable):
+            called with the number of rows from the first one which are
+            all written, whenever it increases. Its errors are raised as
+            `commit_errors` of a `BatchWriteError`, and the batches are
+            still committed.
+
+    """
+
+    def __init__(self, send, workers=None, max_pending=None, start=0,
+                 on_commit=None):
+        self.__send = send
+        self.__executor = None
+        self.__lock = threading.Lock()
+        self.__committed = []
+        self.__failed = []
+        self.__commit_errors = []
+        self.__on_commit = on_commit
+        self.__watermark = start
+        self.__pending_stops = {}
+        if workers is not None and workers > 1:
+            if max_pending is None:
+                max_pending = workers * 2
+            self.__executor = ThreadPoolExecutor(max_workers=workers)
+            self.__pending = threading.BoundedSemaphore(max_pending)
+
+    @property
+    def committed(self):
+        with self.__lock:
+            return sorted(self.__committed)
+
+    def submit(self, batch):
+        '''Send a batch, raising `BatchWriteError` if a batch has failed.
+        '''
+        if self.__executor is None:
+            try:
+                self.__send(batch)
+            except Exception as exception:
+                self.__failed.append((batch.start, batch.stop, exception))
+                raise self.__error()
+            with self.__lock:
+                self.__commit(batch)
+            if self.__commit_errors:
+                raise self.__error()
+            return
+
+        # Stop producing as soon as a batch has failed
+        if self.__failed or self.__commit_errors:
+            self.close()
+        self.__pending.acquire()
+        try:
+            future = self.__executor.submit(self.__send, batch)
+        except Exception:
+            self.__pending.release()
+            raise
+        future.add_done_callback(
+            lambda future: self.__on_done(batch, future))
+
+    def close(self, raise_errors=True):
+        '''Wait for batches in flight and raise failures, if any.
+        '''
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+        if raise_errors and (self.__failed or self.__commit_errors):
+            raise self.__error()
+
+    # Private
+
+    def __on_done(self, batch, future):
+        try:
+            exception = future.exception()
+            with self.__lock:
+                if exception is None:
+                    self.__commit(batch)
+                else:
+                    log.error('Failed to write rows {}-{}: {}'.format(
+                        batch.start, batch.stop - 1, exception))
+                    self.__failed.append((batch.start, batch.stop, exception))
+        finally:
+            self.__pending.release()
+
+    def __commit(self, batch):
+        self.__committed.append((batch.start, batch.stop))
+        # Advance the watermark over contiguous committed batches
+        self.__pending_stops[batch.start] = batch.stop
+        watermark = self.__watermark
+        while watermark in self.__pending_stops:
+            watermark = self.__pending_stops.pop(watermark)
+        if watermark != self.__watermark:
+            self.__watermark = watermark
+            if self.__on_commit is not None:
+                # The batch is written even if the callback fails
+                try:
+                    self.__on_commit(watermark)
+                except Exception as exception:
+                    log.error('Failed to commit {} rows: {}'.format(
+                        watermark, exception))
+                    self.__commit_errors.append((watermark, exception))
+
+    def __error(self):
+        with self.__lock:
+            return BatchWriteError(sorted(self.__committed),
+                                   sorted(self.__failed, key=lambda f: f[:2]),
+                                   list(self.__commit_errors))
+
+
+class Checkpoint(object):
+    """Progress of a write, to resume it after a failure
+
+    It holds the number of rows from the first one which are all written.
+    A write resumed from a checkpoint skips these rows, so the input has to
+    yield the same rows in the same order. Batches in flight when the write
+    failed are written again, which is safe with the `upsert` method.
+
+    # Arguments
+        path (str):
+            JSON file where the progress is saved. It's removed when the
+            write is finished.
+        callback (callable):
+            called with the number of written rows whenever it increases.
+        start (int):
+            number of written rows if there is no saved progress.
+
+    """
+
+    def __init__(self, path=None, callback=None, start=0):
+        self.__path = path
+        self.__callback = callback
+        self.__start = start
+
+    def load(self, bucket):
+        '''Return the number of written rows of the `bucket` write.
+        '''
+        if self.__path is None or not os.path.exists(self.__path):
+            return self.__start
+        with io.open(self.__path, encoding='utf-8') as file:
+            progress = json.load(file)
+        if progress['bucket'] != bucket:
+            message = 'Checkpoint "%s" is for bucket "%s".' % (
+                self.__path, progress['bucket'])
+            raise tableschema.exceptions.StorageError(message)
+        return progress['rows']
+
+    def save(self, bucket, rows):
+        '''Save the number of written rows of the `bucket` write.
+        '''
+        if self.__path is not None:
+            temp_path = self.__path + '.tmp'
+            with io.open(temp_path, 'w', encoding='utf-8') as file:
+                file.write(json.dumps({'bucket': bucket, 'rows': rows}))
+            _replace(temp_path, self.__path)
+        if self.__callback is not None:
+            self.__callback(rows)
+
+    def finish(self):
+        '''Remove the saved progress of a finished write.
+        '''
+        if self.__path is not None and os.path.exists(self.__path):
+            os.remove(self.__path)
+
+
+def encode_records(params, records, dumps=None):
+    '''Return a JSON request body from `params` and `records` encoded as
+    UTF-8 JSON bytes. The params are encoded by `dumps`, the default JSON
+    backend if `None`.
+    '''
+    if dumps is None:
+        dumps = get_backend().dumps
+    head = dumps(params)[:-1]
+    if params:
+        head += b', '
+    return head + b'"records": [' + b', '.join(records) + b']}'
+
+
+# Internal
+
+_replace = getattr(os, 'replace', os.rename)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import json
+import pytest
+aiohttp = pytest.importorskip('aiohttp')
+import asyncio  # noqa
+from aiohttp import web  # noqa
+from aiohttp.test_utils import TestServer  # noqa
+from tabulator import Stream  # noqa
+from tableschema_ckan_datastore import AsyncStorage, BatchWriteError  # noqa
+
+
+# Helpers
+
+def load_response(name):
+    path = 'tests/mock_responses/{}.json'.format(name)
+    return json.load(io.open(path, encoding='utf-8'))
+
+
+def run_with_ckan(main, handlers):
+    '''Run `main(storage, requests)` against a local server responding
+    to CKAN actions with `handlers[action](request)`.'''
+    requests = []
+
+    async def handle(request):
+        action = request.match_info['action']
+        body = await request.read()
+        requests.append((action, dict(request.query),
+                         json.loads(body) if body else None))
+        return web.json_response(handlers[action](requests[-1]))
+
+    async def run():
+        app = web.Application()
+        app.router.add_route('*', '/api/3/action/{action}', handle)
+        async with TestServer(app) as server:
+            async with AsyncStorage(base_url=str(server.make_url('/')),
+                                    dataset_id='my-dataset-id') as storage:
+                return await main(storage, requests)
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+
+def search_handler(*names):
+    '''Return a handler responding with `names` responses in turn.'''
+    responses = [load_response(name) for name in names]
+
+    def handler(request):
+        return responses.pop(0) if len(responses) > 1 else responses[0]
+    return handler
+
+
+# Tests
+
+class TestAsyncStorage():
+
+    def test_async_storage_repr(self):
+        storage = AsyncStorage(base_url='https://demo.ckan.org/')
+        assert str(storage) == 'AsyncStorage <https://demo.ckan.org>'
+
+    def test_async_storage_buckets(self):
+        async def main(storage, requests):
+            return await storage.buckets()
+        buckets = run_with_ckan(main, {
+            'package_show': search_handler('package_show'),
+            'datastore_search': search_handler(
+                'datastore_search_table_metadata_01',
+                'datastore_search_table_metadata_02'),
+        })
+        assert buckets == ['bd79c992-40f0-454a-a0ff-887f84a792fb',
+                           '79843e49-7974-411c-8eb5-fb2d1111d707']
+
+    def test_async_storage_delete(self):
+        async def main(storage, requests):
+            await storage.delete()
+            return requests
+        requests = run_with_ckan(main, {
+            'package_show': search_handler('package_show'),
+            'datastore_search': search_handler(
+                'datastore_search_table_metadata_01',
+                'datastore_search_table_metadata_02'),
+            'datastore_delete': search_handler('datastore_delete'),
+        })
+        deleted = [r[2]['resource_id'] for r in requests
+                   if r[0] == 'datastore_delete']
+        assert sorted(deleted) == ['79843e49-7974-411c-8eb5-fb2d1111d707',
+                                   'bd79c992-40f0-454a-a0ff-887f84a792fb']
+
+    def test_async_storage_read_iter(self):
+        async def main(storage, requests):
+            return [row async for row in storage.iter(
+                '79843e49-7974-411c-8eb5-fb2d1111d707')]
+        rows = run_with_ckan(main, {
+            'datastore_search': search_handler(
+                'datastore_search_describe',
+                'datastore_search_rows',
+                'datastore_search_rows_empty'),
+        })
+        assert [row['id'] for row in rows] == [1, 2, 3]
+        assert rows[2]['name'] is None
+
+    def test_async_storage_write(self):
+        async def main(storage, requests):
+            articles_data = \
+                Stream('data/articles.csv', headers=1, encoding='utf-8').open()
+            await storage.write('79843e49-7974-411c-8eb5-fb2d1111d707',
+                                articles_data, batch_size=2, workers=2)
+            return requests
+        requests = run_with_ckan(main, {
+            'datastore_search': search_handler('datastore_search_describe'),
+            'datastore_upsert': search_handler('datastore_upsert'),
+        })
+        sizes = sorted(len(r[2]['records']) for r in requests
+                       if r[0] == 'datastore_upsert')
+        assert sizes == [1, 2]
+
+    def test_async_storage_write_failed(self):
+        async def main(storage, requests):
+            articles_data = \
+                Stream('data/articles.csv', headers=1, encoding='utf-8').open()
+            await storage.write('79843e49-7974-411c-8eb5-fb2d1111d707',
+                                articles_data, batch_size=1)
+
+        def upsert(request):
+            if request[2]['records'][0]['id'] == '2':
+                return {'success': False, 'error': {'message': 'Failed'}}
+            return {'success': True, 'result': {}}
+        with pytest.raises(BatchWriteError) as excinfo:
+            run_with_ckan(main, {
+                'datastore_search': search_handler(
+                    'datastore_search_describe'),
+                'datastore_upsert': upsert,
+            })
+        assert excinfo.value.committed[0] == (0, 1)
+        assert [f[:2] for f in excinfo.value.failed] == [(1, 2)]
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import unicode_literals
+
+import io
+import json
+import datetime
+import tableschema
+import pytest
+from decimal import Decimal
+from tableschema_ckan_datastore.mapper import Mapper
+
+
+# Tests
+
+class TestMapper():
+
+    def setup_method(self):
+        self.mapper = Mapper()
+        self.schema = tableschema.Schema(
+            json.load(io.open('data/articles.json', encoding='utf-8')))
+
+    def test_mapper_compile_cached(self):
+        schema = tableschema.Schema(self.schema.descriptor)
+        assert self.mapper.compile_restore_row(self.schema) is \
+            self.mapper.compile_restore_row(schema)
+        assert self.mapper.compile_convert_row(self.schema) is \
+            self.mapper.compile_convert_row(schema)
+
+    def test_mapper_restore_row(self):
+        record = {
+            'id': 1, 'parent': None, 'name': '', 'current': True,
+            'rating': 9.5, 'created_year': 2015,
+            'created_date': '2015-01-01', 'created_time': '03:00:00',
+            'created_datetime': '2015-01-01T03:00:00',
+            'stats': {'chars': 560}, 'persons': ['mike'],
+            'location': {'type': 'Point', 'coordinates': [50.0, 50.0]}
+        }
+        assert self.mapper.restore_row(record, self.schema) == {
+            'id': 1, 'parent': None, 'name': None, 'current': True,
+            'rating': Decimal('9.5'), 'created_year': 2015,
+            'created_date': datetime.date(2015, 1, 1),
+            'created_time': datetime.time(3, 0),
+            'created_datetime': datetime.datetime(2015, 1, 1, 3, 0),
+            'stats': {'chars': 560}, 'persons': ['mike'],
+            'location': {'type': 'Point', 'coordinates': [50.0, 50.0]}
+        }
+
+    def test_mapper_restore_columns(self):
+        records = [
+            {'id': 1, 'name': '', 'rating': 9.5,
+             'created_datetime': '2015-01-01T03:00:00'},
+            {'id': 2, 'name': 'Taxes', 'rating': None,
+             'created_datetime': '2015-01-01T03:00:00Z'},
+        ]
+        schema = tableschema.Schema({'fields': [
+            {'name': 'id', 'type': 'integer'},
+            {'name': 'name', 'type': 'string'},
+            {'name': 'rating', 'type': 'number'},
+            {'name': 'created_datetime', 'type': 'datetime'},
+        ]})
+        columns = self.mapper.compile_restore_columns(schema)(records)
+        assert columns['id'] == [1, 2]
+        assert columns['name'] == [None, 'Taxes']
+        assert columns['rating'] == [Decimal('9.5'), None]
+        assert columns['created_datetime'][0] == \
+            datetime.datetime(2015, 1, 1, 3, 0)
+        # Values which can't be made at once are cast one by one
+        assert columns['created_datetime'][1].utcoffset() == \
+            datetime.timedelta(0)
+
+    def test_mapper_restore_row_constraints(self):
+        record = dict.fromkeys(self.schema.field_names)
+        with pytest.raises(tableschema.exceptions.CastError):
+            self.mapper.restore_row(record, self.schema)
+
+    def test_mapper_convert_row(self):
+        row = ['1', '', 'Taxes', 'True', '', '2015', '', '', '',
+               '{"chars": 560}', '', '']
+        assert self.mapper.convert_row(row, self.schema) == {
+            'id': '1', 'parent': None, 'name': 'Taxes', 'current': 'True',
+            'rating': None, 'created_year': '2015', 'created_date': None,
+            'created_time': None, 'created_datetime': None,
+            'stats': {'chars': 560}, 'persons': None, 'location': None
+        }
+
+        # Rows missing values aren't converted
+        with pytest.raises(IndexError):
+            self.mapper.convert_row(row[:3], self.schema)
+
+    def test_mapper_descriptor_to_datastore_dict_indexes(self):
+        descriptor = dict(self.schema.descriptor,
+                          indexes=['name', ['created_year', 'name']])
+        descriptor['fields'] = list(descriptor['fields'])
+        descriptor['fields'][2] = dict(descriptor['fields'][2],
+                                       title='Name', description='Full name')
+        datastore_dict = self.mapper.descriptor_to_datastore_dict(
+            descriptor, 'articles')
+        assert datastore_dict['primary_key'] == 'id'
+        # Foreign key fields are indexed too
+        assert datastore_dict['indexes'] == \
+            ['name', 'created_year,name', 'parent']
+        assert datastore_dict['fields'][2]['info'] == \
+            {'label': 'Name', 'notes': 'Full name'}
+        assert 'info' not in datastore_dict['fields'][0]
+
+        # Labels and notes are restored
+        fields = self.mapper.datastore_fields_to_descriptor(
+            datastore_dict['fields'])
+        assert fields['fields'][2]['title'] == 'Name'
+        assert fields['fields'][2]['description'] == 'Full name'
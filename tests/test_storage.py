@@ -6,14 +6,27 @@ from __future__ import unicode_literals
 
 import io
 import json
+import socket
+import zlib
 # import unittest
 import tableschema
 from decimal import Decimal
 import datetime
+import requests
 import requests_mock
 import pytest
 from tabulator import Stream
-from tableschema_ckan_datastore import Storage
+from tableschema_ckan_datastore import Storage, BatchWriteError, FileCache
+from tableschema_ckan_datastore import RequestError
+from tableschema_ckan_datastore import BatchSizer, Checkpoint, FingerprintIndex
+from tableschema_ckan_datastore import InMemoryMetrics, StatsdMetrics
+
+
+# Helpers
+
+def gzip_content(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
 
 
 # Tests
@@ -29,7 +42,8 @@ class TestStorage():
 
     @pytest.fixture()
     def mock_request(self):
-        return requests_mock.Mocker().__enter__()
+        with requests_mock.Mocker() as mock_request:
+            yield mock_request
 
     def test_storage_repr(self):
         assert str(self.storage) == 'Storage <https://demo.ckan.org>'
@@ -60,8 +74,9 @@ class TestStorage():
         assert bucket_list == ['bd79c992-40f0-454a-a0ff-887f84a792fb',
                                '79843e49-7974-411c-8eb5-fb2d1111d707']
 
+        # The first page holds the total, so there are no more pages
         history = mock_request.request_history
-        assert len(history) == 3
+        assert len(history) == 2
 
         # Calling again shouldn't make new requests
         bucket_list = self.storage.buckets
@@ -69,7 +84,124 @@ class TestStorage():
                                '79843e49-7974-411c-8eb5-fb2d1111d707']
 
         history = mock_request.request_history
-        assert len(history) == 3
+        assert len(history) == 2
+
+    def test_storage_buckets_pages(self, mock_request):
+        names = ['bucket-%02d' % i for i in range(25)]
+
+        def search(request, context):
+            offset = int(request.qs.get('offset', ['0'])[0])
+            limit = int(request.qs['limit'][0])
+            records = [{'name': name} for name in names[offset:offset + limit]]
+            return {'success': True,
+                    'result': {'records': records, 'total': len(names)}}
+
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',
+                         json=search)
+
+        storage = Storage(base_url='https://demo.ckan.org/',
+                          bucket_page_size=10, bucket_workers=2)
+        assert storage.buckets == names
+
+        # Pages after the first one are fetched by offset
+        offsets = sorted(int(r.qs.get('offset', ['0'])[0])
+                         for r in mock_request.request_history)
+        assert offsets == [0, 10, 20]
+
+    def test_storage_package_buckets(self, mock_request):
+
+        mock_package_show_fp = "tests/mock_responses/package_show.json"
+        mock_package_show = \
+            json.load(io.open(mock_package_show_fp, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/package_show',
+                         json=mock_package_show)
+
+        storage = Storage(base_url='https://demo.ckan.org/',
+                          dataset_id='my-dataset-id', package_buckets=True)
+        assert storage.buckets == ['bd79c992-40f0-454a-a0ff-887f84a792fb',
+                                   '79843e49-7974-411c-8eb5-fb2d1111d707']
+
+        # The DataStore table list isn't searched
+        assert len(mock_request.request_history) == 1
+
+    def test_storage_session_adapter(self):
+        adapter = requests_mock.Adapter()
+        storage = Storage(base_url='https://demo.ckan.org/', adapter=adapter)
+
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        adapter.register_uri('GET', 'https://demo.ckan.org/api/3/action/datastore_search',  # noqa
+                             json=mock_datastore_search_03)
+
+        storage.describe('79843e49-7974-411c-8eb5-fb2d1111d707')
+        storage.describe('bd79c992-40f0-454a-a0ff-887f84a792fb')
+
+        # requests went through the mounted adapter
+        assert adapter.call_count == 2
+
+
+    @pytest.mark.parametrize('ttl, requests', [(None, 2), (0, 4)])
+    def test_storage_buckets_file_cache(self, mock_request, tmpdir,
+                                        ttl, requests):
+
+        mock_package_show_fp = "tests/mock_responses/package_show.json"
+        mock_package_show = \
+            json.load(io.open(mock_package_show_fp, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/package_show',
+                         json=mock_package_show)
+
+        mock_datastore_search_fp_01 = \
+            "tests/mock_responses/datastore_search_table_metadata_01.json"
+        mock_datastore_search_01 = \
+            json.load(io.open(mock_datastore_search_fp_01, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',
+                         json=mock_datastore_search_01)
+
+        # A second storage shares the buckets through the cache files
+        for _ in range(2):
+            storage = Storage(base_url='https://demo.ckan.org/',
+                              dataset_id='my-dataset-id',
+                              cache=FileCache(str(tmpdir), ttl=ttl))
+            assert storage.buckets == \
+                ['bd79c992-40f0-454a-a0ff-887f84a792fb',
+                 '79843e49-7974-411c-8eb5-fb2d1111d707']
+        assert len(mock_request.request_history) == requests
+
+    def test_storage_delete_updates_cache(self, mock_request):
+
+        mock_package_show_fp = "tests/mock_responses/package_show.json"
+        mock_package_show = \
+            json.load(io.open(mock_package_show_fp, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/package_show',
+                         json=mock_package_show)
+
+        mock_datastore_search_fp_01 = \
+            "tests/mock_responses/datastore_search_table_metadata_01.json"
+        mock_datastore_search_01 = \
+            json.load(io.open(mock_datastore_search_fp_01, encoding='utf-8'))
+        mock_datastore_search_fp_02 = \
+            "tests/mock_responses/datastore_search_table_metadata_02.json"
+        mock_datastore_search_02 = \
+            json.load(io.open(mock_datastore_search_fp_02, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',
+                         [{'json': mock_datastore_search_01},
+                          {'json': mock_datastore_search_02}])
+
+        mock_datastore_delete = "tests/mock_responses/datastore_delete.json"
+        mock_datastore_delete = \
+            json.load(io.open(mock_datastore_delete, encoding='utf-8'))
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_delete',  # noqa
+                          json=mock_datastore_delete)
+
+        self.storage.delete('79843e49-7974-411c-8eb5-fb2d1111d707')
+
+        # The bucket list isn't fetched again
+        assert self.storage.buckets == \
+            ['bd79c992-40f0-454a-a0ff-887f84a792fb']
+        assert len(mock_request.request_history) == 3
+
 
     def test_storage_describe(self, mock_request):
 
@@ -134,8 +266,8 @@ class TestStorage():
 
         # delete endpoint was called
         history = mock_request.request_history
-        assert len(history) == 4
-        delete_request = history[3]
+        assert len(history) == 3
+        delete_request = history[2]
         assert delete_request.url == \
             'https://demo.ckan.org/api/3/action/datastore_delete'
         assert delete_request.json()['resource_id'] == \
@@ -171,7 +303,7 @@ class TestStorage():
 
         # delete endpoint was called
         history = mock_request.request_history
-        assert len(history) == 3
+        assert len(history) == 2
 
     def test_storage_delete_all(self, mock_request):
 
@@ -206,8 +338,8 @@ class TestStorage():
 
         # delete endpoint was called
         history = mock_request.request_history
-        assert len(history) == 5
-        delete_request = history[4]
+        assert len(history) == 4
+        delete_request = history[3]
         assert delete_request.url == \
             'https://demo.ckan.org/api/3/action/datastore_delete'
         assert delete_request.json()['resource_id'] == \
@@ -281,6 +413,250 @@ class TestStorage():
         assert create_request.url == \
             'https://demo.ckan.org/api/3/action/datastore_create'
 
+    def test_storage_bucket_workers(self, mock_request):
+        storage = Storage(base_url='https://demo.ckan.org/',
+                          dataset_id='my-dataset-id', bucket_workers=4)
+
+        mock_package_show_fp = "tests/mock_responses/package_show.json"
+        mock_package_show = \
+            json.load(io.open(mock_package_show_fp, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/package_show',
+                         json=mock_package_show)
+
+        # Both buckets exist
+        mock_datastore_search_fp_01 = \
+            "tests/mock_responses/datastore_search_table_metadata_01.json"
+        mock_datastore_search_01 = \
+            json.load(io.open(mock_datastore_search_fp_01, encoding='utf-8'))
+        mock_datastore_search_fp_02 = \
+            "tests/mock_responses/datastore_search_table_metadata_02.json"
+        mock_datastore_search_02 = \
+            json.load(io.open(mock_datastore_search_fp_02, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',
+                         [{'json': mock_datastore_search_01},
+                          {'json': mock_datastore_search_02}])
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_delete',  # noqa
+                          json={'success': True, 'result': {}})
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_create',  # noqa
+                          json={'success': True, 'result': {}})
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          json={'success': True, 'result': {}})
+
+        buckets = ['79843e49-7974-411c-8eb5-fb2d1111d707',
+                   'bd79c992-40f0-454a-a0ff-887f84a792fb']
+        articles_schema = \
+            json.load(io.open('data/articles.json', encoding='utf-8'))
+        comments_schema = \
+            json.load(io.open('data/comments.json', encoding='utf-8'))
+        storage.create(buckets, [articles_schema, comments_schema],
+                       force=True)
+        storage.write_buckets({
+            buckets[0]: Stream('data/articles.csv', headers=1,
+                               encoding='utf-8').open(),
+            buckets[1]: Stream('data/comments.csv', headers=1,
+                               encoding='utf-8').open(),
+        })
+
+        # Buckets are listed once
+        history = mock_request.request_history
+        assert [r.url.split('/')[-1].split('?')[0] for r in history[:3]] == \
+            ['package_show', 'datastore_search', 'datastore_delete']
+        for action in ['datastore_delete', 'datastore_create',
+                       'datastore_upsert']:
+            assert sorted(r.json()['resource_id'] for r in history
+                          if r.url.endswith(action)) == buckets
+        assert sorted(storage.buckets) == buckets
+
+    @pytest.mark.parametrize('primary_key', [False, True])
+    def test_storage_sync(self, mock_request, tmpdir, primary_key):
+        bucket = '79843e49-7974-411c-8eb5-fb2d1111d707'
+
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        mock_datastore_search_fp_04 = \
+            "tests/mock_responses/datastore_search_rows.json"
+        mock_datastore_search_04 = \
+            json.load(io.open(mock_datastore_search_fp_04, encoding='utf-8'))
+        mock_datastore_search_fp_05 = \
+            "tests/mock_responses/datastore_search_rows_empty.json"
+        mock_datastore_search_05 = \
+            json.load(io.open(mock_datastore_search_fp_05, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',
+                         [{'json': mock_datastore_search_03},
+                          {'json': mock_datastore_search_04},
+                          {'json': mock_datastore_search_05}])
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          json={'success': True, 'result': {}})
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_delete',  # noqa
+                          json={'success': True, 'result': {}})
+        descriptor = self.storage.describe(bucket)
+        if primary_key:
+            self.storage.describe(bucket, dict(descriptor, primaryKey='id'))
+
+        # Rows of the bucket as read back, with the second renamed, the
+        # third removed and a fourth added
+        rows = [{k: v for k, v in r.items() if k != '_id'}
+                for r in mock_datastore_search_04['result']['records']]
+        rows[1]['name'] = 'Renamed'
+        rows[2] = dict(rows[0], id=4)
+        index = FingerprintIndex(str(tmpdir.join('index.json')))
+        stats = self.storage.sync(bucket, rows, key='id', index=index)
+        assert stats == {'inserted': 1, 'updated': 1, 'deleted': 1,
+                         'unchanged': 1}
+
+        # Only the diff is written
+        history = mock_request.request_history
+        requests = [(r.url.split('/')[-1], r.json()) for r in history
+                    if r.method == 'POST']
+        if primary_key:
+            # Changed rows are upserted by primary key
+            assert [action for action, _ in requests] == \
+                ['datastore_upsert', 'datastore_delete']
+            assert requests[0][1]['method'] == 'upsert'
+        else:
+            # Changed rows are deleted first, so inserting them again
+            # doesn't duplicate them
+            assert [action for action, _ in requests] == \
+                ['datastore_delete', 'datastore_upsert', 'datastore_delete']
+            assert requests[0][1]['filters'] == {'id': [2]}
+            assert requests[1][1]['method'] == 'insert'
+        upsert = requests[-2][1]
+        assert [r['id'] for r in upsert['records']] == [2, 4]
+        assert requests[-1][1]['filters'] == {'id': [3]}
+
+        # The next sync compares with the index without reading the bucket
+        count = len(history)
+        stats = self.storage.sync(bucket, rows, key='id', index=index)
+        assert stats == {'inserted': 0, 'updated': 0, 'deleted': 0,
+                         'unchanged': 3}
+        assert len(mock_request.request_history) == count
+
+    def test_storage_sync_no_key(self, mock_request):
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',
+                         json=mock_datastore_search_03)
+        with pytest.raises(tableschema.exceptions.StorageError):
+            self.storage.sync('79843e49-7974-411c-8eb5-fb2d1111d707', [])
+
+    def test_storage_replace(self, mock_request):
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',
+                         json={'success': True, 'result': {'records': [
+                             {'name': 'articles', 'alias_of': 'previous'}]}})
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_create',  # noqa
+                          json={'success': True,
+                                'result': {'resource_id': 'staging'}})
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          json={'success': True, 'result': {}})
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_delete',  # noqa
+                          json={'success': True, 'result': {}})
+        mock_request.get('https://demo.ckan.org/api/3/action/resource_show',
+                         json={'success': True, 'result': {
+                             'id': 'previous',
+                             'datastore_replace_alias': 'articles'}})
+        mock_request.post('https://demo.ckan.org/api/3/action/resource_delete',  # noqa
+                          json={'success': True, 'result': None})
+
+        articles_schema = \
+            json.load(io.open('data/articles.json', encoding='utf-8'))
+        rows = Stream('data/articles.csv', headers=1,
+                      encoding='utf-8').open()
+        bucket = self.storage.replace('articles', rows,
+                                      descriptor=articles_schema)
+        assert bucket == 'staging'
+
+        requests = [(r.url.split('/')[-1], r.json())
+                    for r in mock_request.request_history
+                    if r.method == 'POST']
+        actions = [action for action, params in requests]
+        assert actions == ['datastore_create', 'datastore_upsert',
+                           'datastore_create', 'datastore_create',
+                           'datastore_create', 'datastore_delete',
+                           'resource_delete']
+
+        # Rows are inserted in a new resource without a primary key
+        assert requests[0][1]['resource']['package_id'] == 'my-dataset-id'
+        assert requests[0][1]['resource']['datastore_replace_alias'] == \
+            'articles'
+        assert 'primary_key' not in requests[0][1]
+        assert requests[1][1]['method'] == 'insert'
+
+        # The primary key is created before the alias is moved
+        assert requests[2][1]['resource_id'] == 'staging'
+        assert requests[2][1]['primary_key'] == articles_schema['primaryKey']
+        assert 'aliases' not in requests[2][1]
+        assert requests[3][1] == {'resource_id': 'previous', 'aliases': [],
+                                  'force': True}
+        assert requests[4][1] == {'resource_id': 'staging',
+                                  'aliases': ['articles'], 'force': True}
+        assert requests[5][1]['resource_id'] == 'previous'
+
+        # The resource created by the previous replace is deleted
+        assert requests[6][1] == {'id': 'previous'}
+
+    @pytest.mark.parametrize('created', [True, False])
+    @pytest.mark.parametrize('failure', ['write', 'index'])
+    def test_storage_replace_failed(self, mock_request, created, failure):
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',
+                         json={'success': True, 'result': {'total': 1,
+                               'records': [{'name': 'articles',
+                                            'alias_of': 'previous'}]}})
+
+        # The deferred primary key fails on duplicate rows
+        def create(request, context):
+            if failure == 'index' and 'primary_key' in request.json():
+                context.status_code = 409
+                return {'success': False,
+                        'error': {'message': 'Duplicate key'}}
+            return {'success': True, 'result': {'resource_id': 'staging'}}
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_create',  # noqa
+                          json=create)
+        if failure == 'write':
+            mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                              status_code=500, json={'success': False})
+        else:
+            mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                              json={'success': True, 'result': {}})
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_delete',  # noqa
+                          json={'success': True, 'result': {}})
+        mock_request.get('https://demo.ckan.org/api/3/action/package_show',
+                         json={'success': True, 'result': {'resources': []}})
+        mock_request.get('https://demo.ckan.org/api/3/action/resource_show',
+                         json={'success': True, 'result': {
+                             'id': 'staging',
+                             'datastore_replace_alias': 'articles'}})
+        mock_request.post('https://demo.ckan.org/api/3/action/resource_delete',  # noqa
+                          json={'success': True, 'result': None})
+
+        articles_schema = \
+            json.load(io.open('data/articles.json', encoding='utf-8'))
+        rows = Stream('data/articles.csv', headers=1,
+                      encoding='utf-8').open()
+        staging_bucket = None if created else 'staging'
+        with pytest.raises(tableschema.exceptions.StorageError):
+            self.storage.replace('articles', rows, descriptor=articles_schema,
+                                 staging_bucket=staging_bucket)
+
+        # The alias still points to the previous table
+        requests = [(r.url.split('/')[-1], r.json())
+                    for r in mock_request.request_history
+                    if r.method == 'POST']
+        assert not [params for action, params in requests
+                    if 'aliases' in params]
+
+        # Only the staging table is deleted, with its resource if created
+        deleted = [(action, params.get('resource_id', params.get('id')))
+                   for action, params in requests
+                   if action in ['datastore_delete', 'resource_delete']]
+        if created:
+            assert deleted == [('resource_delete', 'staging')]
+        else:
+            assert deleted == [('datastore_delete', 'staging')]
+
     @pytest.mark.parametrize('generator', [True, False])
     def test_storage_write(self, generator):
         with requests_mock.Mocker() as mock_request:
@@ -315,7 +691,418 @@ class TestStorage():
                 'https://demo.ckan.org/api/3/action/datastore_upsert'
 
 
-    def test_storage_read_iter(self, mock_request):
+    @pytest.mark.parametrize('options, upserts', [
+        ({'batch_size': 2}, [2, 1]),
+        ({'batch_size': 1}, [1, 1, 1]),
+        ({'batch_size': None, 'max_batch_bytes': 1}, [1, 1, 1]),
+        ({'batch_size': None}, [3]),
+    ])
+    def test_storage_write_batches(self, mock_request, options, upserts):
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         json=mock_datastore_search_03)
+
+        mock_datastore_upsert_fp = \
+            "tests/mock_responses/datastore_upsert.json"
+        mock_datastore_upsert = \
+            json.load(io.open(mock_datastore_upsert_fp, encoding='utf-8'))
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          json=mock_datastore_upsert)
+
+        articles_data = \
+            Stream('data/articles.csv', headers=1, encoding='utf-8').open()
+        self.storage.write('79843e49-7974-411c-8eb5-fb2d1111d707',
+                           articles_data, **options)
+
+        # upsert endpoint was called once per batch
+        history = mock_request.request_history[1:]
+        assert [len(r.json()['records']) for r in history] == upserts
+        ids = [rec['id'] for r in history for rec in r.json()['records']]
+        assert ids == ['1', '2', '3']
+
+
+    @pytest.mark.parametrize('workers', [None, 2])
+    def test_storage_write_batches_failed(self, mock_request, workers):
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         json=mock_datastore_search_03)
+
+        def upsert(request, context):
+            if request.json()['records'][0]['id'] == '2':
+                return {'success': False, 'error': {'message': 'Failed'}}
+            return {'success': True, 'result': {}}
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          json=upsert)
+
+        articles_data = \
+            Stream('data/articles.csv', headers=1, encoding='utf-8').open()
+        with pytest.raises(BatchWriteError) as excinfo:
+            self.storage.write('79843e49-7974-411c-8eb5-fb2d1111d707',
+                               articles_data, batch_size=1, workers=workers)
+        assert isinstance(excinfo.value, tableschema.exceptions.StorageError)
+        assert [f[:2] for f in excinfo.value.failed] == [(1, 2)]
+        assert excinfo.value.committed[0] == (0, 1)
+
+    def test_storage_write_checkpoint(self, mock_request, tmpdir):
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         json=mock_datastore_search_03)
+
+        # Second batch fails on the first write only
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          [{'json': {'success': True, 'result': {}}},
+                           {'json': {'success': False,
+                                     'error': {'message': 'Failed'}}},
+                           {'json': {'success': True, 'result': {}}}])
+
+        checkpoint = str(tmpdir.join('checkpoint.json'))
+        with pytest.raises(BatchWriteError):
+            articles_data = \
+                Stream('data/articles.csv', headers=1, encoding='utf-8').open()
+            self.storage.write('79843e49-7974-411c-8eb5-fb2d1111d707',
+                               articles_data, batch_size=1,
+                               checkpoint=checkpoint)
+        assert json.load(io.open(checkpoint, encoding='utf-8')) == \
+            {'bucket': '79843e49-7974-411c-8eb5-fb2d1111d707', 'rows': 1}
+
+        # Resumed write skips the written row
+        progress = []
+        articles_data = \
+            Stream('data/articles.csv', headers=1, encoding='utf-8').open()
+        self.storage.write('79843e49-7974-411c-8eb5-fb2d1111d707',
+                           articles_data, batch_size=2,
+                           checkpoint=Checkpoint(checkpoint,
+                                                 callback=progress.append))
+        upsert = mock_request.request_history[-1].json()
+        assert [r['id'] for r in upsert['records']] == ['2', '3']
+        assert progress == [3]
+        assert not tmpdir.join('checkpoint.json').exists()
+
+    @pytest.mark.parametrize('workers', [None, 2])
+    def test_storage_write_checkpoint_callback_failed(self, mock_request,
+                                                      workers):
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         json=mock_datastore_search_03)
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          json={'success': True, 'result': {}})
+
+        def callback(rows):
+            raise ValueError('Callback failed')
+
+        # Errors of the callback are raised, not swallowed by the workers
+        articles_data = \
+            Stream('data/articles.csv', headers=1, encoding='utf-8').open()
+        with pytest.raises(BatchWriteError) as excinfo:
+            self.storage.write('79843e49-7974-411c-8eb5-fb2d1111d707',
+                               articles_data, batch_size=1, workers=workers,
+                               checkpoint=Checkpoint(callback=callback))
+        assert excinfo.value.commit_errors
+        assert all(isinstance(error, ValueError)
+                   for rows, error in excinfo.value.commit_errors)
+
+        # Written batches are committed, not failed
+        committed = set(excinfo.value.committed)
+        failed = set(f[:2] for f in excinfo.value.failed)
+        assert committed
+        assert not committed & failed
+
+
+    @pytest.mark.parametrize('json_backend', ['orjson', 'json'])
+    def test_storage_write_typed_rows(self, mock_request, json_backend):
+        storage = Storage(base_url='https://demo.ckan.org/',
+                          json_backend=json_backend)
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         json=mock_datastore_search_03)
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          json={'success': True, 'result': {}})
+
+        # Rows cast by the schema are encoded without converting them
+        schema = tableschema.Schema(
+            storage.describe('79843e49-7974-411c-8eb5-fb2d1111d707'))
+        articles_data = \
+            Stream('data/articles.csv', headers=1, encoding='utf-8').open()
+        # The last row has an extra empty cell
+        rows = [schema.cast_row(row) for row in list(articles_data)[:2]]
+        rows[1][4] = Decimal('0.1000000000000000000000000001')
+        storage.write('79843e49-7974-411c-8eb5-fb2d1111d707', rows)
+        request = mock_request.request_history[-1]
+        record = request.json()['records'][0]
+        assert record['rating'] == '9.5'
+        # Decimals keep their precision
+        assert request.json()['records'][1]['rating'] == \
+            '0.1000000000000000000000000001'
+        # The request params are encoded by the same backend
+        separator = b': ' if json_backend == 'json' else b':'
+        assert request.body.startswith(b'{"resource_id"' + separator)
+        assert record['created_date'] == '2015-01-01'
+        assert record['created_time'] == '03:00:00'
+        assert record['created_datetime'].startswith('2015-01-01T03:00:00')
+        assert record['stats'] == {'chars': 560, 'height': 54.8}
+
+    def test_storage_request_error(self, mock_request):
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',
+                         status_code=404, text='Not Found')
+
+        # Error responses without JSON are storage errors too
+        with pytest.raises(RequestError) as excinfo:
+            self.storage.describe('missing')
+        assert isinstance(excinfo.value, tableschema.exceptions.StorageError)
+        assert excinfo.value.response.status_code == 404
+
+    def test_storage_json_backend_missing(self):
+        with pytest.raises(ValueError):
+            Storage(base_url='https://demo.ckan.org/',
+                    json_backend='missing')
+
+    @pytest.mark.parametrize('format', ['dict', 'numpy', 'pandas', 'arrow'])
+    def test_storage_write_batches_columns(self, mock_request, format):
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         json=mock_datastore_search_03)
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          json={'success': True, 'result': {}})
+
+        data = {
+            'id': [1, 2, 3],
+            'rating': [9.5, None, 7.0],
+            'created_date': ['2015-01-01', '', None],
+            'stats': ['{"chars": 560}', None, {'chars': 970}],
+        }
+        if format == 'numpy':
+            numpy = pytest.importorskip('numpy')
+            data['rating'] = numpy.array([9.5, numpy.nan, 7.0])
+            data['created_date'] = numpy.array(
+                ['2015-01-01', 'NaT', 'NaT'], dtype='datetime64[D]')
+        elif format == 'pandas':
+            pandas = pytest.importorskip('pandas')
+            data['created_date'] = pandas.to_datetime(
+                ['2015-01-01', None, None]).values.astype('datetime64[D]')
+            data = pandas.DataFrame(data)
+        elif format == 'arrow':
+            pyarrow = pytest.importorskip('pyarrow')
+            data['created_date'] = pyarrow.array(
+                [datetime.date(2015, 1, 1), None, None])
+            data['stats'] = ['{"chars": 560}', None, '{"chars": 970}']
+            data = pyarrow.Table.from_pydict(data)
+
+        self.storage.write_batches('79843e49-7974-411c-8eb5-fb2d1111d707',
+                                   data, batch_size=2)
+        upserts = [r.json() for r in mock_request.request_history
+                   if r.method == 'POST']
+        assert [len(u['records']) for u in upserts] == [2, 1]
+        records = [rec for u in upserts for rec in u['records']]
+        assert [r['id'] for r in records] == [1, 2, 3]
+        assert [r['rating'] for r in records] == [9.5, None, 7.0]
+        # pandas holds dates as midnight timestamps
+        assert [r['created_date'] and r['created_date'][:10]
+                for r in records] == ['2015-01-01', None, None]
+        assert [r['stats'] for r in records] == \
+            [{'chars': 560}, None, {'chars': 970}]
+
+    def test_storage_retries(self, mock_request):
+        metrics = InMemoryMetrics()
+        storage = Storage(base_url='https://demo.ckan.org/', retries=2,
+                          backoff_factor=0, metrics=metrics)
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         [{'status_code': 503, 'text': 'Unavailable'},
+                          {'exc': requests.exceptions.ConnectTimeout},
+                          {'json': mock_datastore_search_03}])
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          [{'status_code': 429, 'text': 'Too Many Requests',
+                            'headers': {'Retry-After': '0'}},
+                           {'json': {'success': True, 'result': {}}}])
+
+        # Reads and upserts are retried
+        storage.describe('79843e49-7974-411c-8eb5-fb2d1111d707')
+        articles_data = \
+            Stream('data/articles.csv', headers=1, encoding='utf-8').open()
+        storage.write('79843e49-7974-411c-8eb5-fb2d1111d707', articles_data,
+                      method='upsert')
+        summary = metrics.summary()['requests']
+        assert summary['datastore_search']['retries'] == 2
+        assert summary['datastore_upsert']['retries'] == 1
+
+        # Inserts are not retried
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          [{'status_code': 502, 'text': 'Bad Gateway'},
+                           {'json': {'success': True, 'result': {}}}])
+        articles_data = \
+            Stream('data/articles.csv', headers=1, encoding='utf-8').open()
+        with pytest.raises(BatchWriteError) as excinfo:
+            storage.write('79843e49-7974-411c-8eb5-fb2d1111d707',
+                          articles_data, method='insert')
+        error = excinfo.value.failed[0][2]
+        assert isinstance(error, RequestError)
+        assert isinstance(error, tableschema.exceptions.StorageError)
+        assert error.response.status_code == 502
+
+    def test_storage_write_adaptive(self, mock_request):
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         json=mock_datastore_search_03)
+
+        # The first batch of 3 rows is too large
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          [{'status_code': 413, 'text': 'Too Large'},
+                           {'json': {'success': True, 'result': {}}}])
+
+        sizer = BatchSizer(size=3, target_seconds=60)
+        articles_data = \
+            Stream('data/articles.csv', headers=1, encoding='utf-8').open()
+        self.storage.write('79843e49-7974-411c-8eb5-fb2d1111d707',
+                           articles_data, batch_size=3, adaptive=sizer)
+        upserts = [r.json()['records'] for r in mock_request.request_history
+                   if r.method == 'POST']
+        assert [[rec['id'] for rec in r] for r in upserts] == \
+            [['1', '2', '3'], ['1'], ['2', '3']]
+        assert sizer.size < 3
+
+    @pytest.mark.parametrize('method, exception, split', [
+        ('insert', requests.exceptions.ReadTimeout, False),
+        ('insert', requests.exceptions.ConnectTimeout, True),
+        ('upsert', requests.exceptions.ReadTimeout, True),
+    ])
+    def test_storage_write_adaptive_timeout(self, mock_request, method,
+                                            exception, split):
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         json=mock_datastore_search_03)
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          [{'exc': exception},
+                           {'json': {'success': True, 'result': {}}}])
+
+        # Inserts which may have been written aren't sent again
+        rows = Stream('data/articles.csv', headers=1,
+                      encoding='utf-8').open().read()[:2]
+        sizer = BatchSizer(size=2, target_seconds=60)
+        if split:
+            self.storage.write('79843e49-7974-411c-8eb5-fb2d1111d707', rows,
+                               method=method, batch_size=2, adaptive=sizer)
+        else:
+            with pytest.raises(BatchWriteError):
+                self.storage.write('79843e49-7974-411c-8eb5-fb2d1111d707',
+                                   rows, method=method, batch_size=2,
+                                   adaptive=sizer)
+        upserts = [r.json()['records'] for r in mock_request.request_history
+                   if r.method == 'POST']
+        expected = [['1', '2'], ['1'], ['2']] if split else [['1', '2']]
+        assert [[rec['id'] for rec in r] for r in upserts] == expected
+
+    def test_batch_sizer(self):
+        sizer = BatchSizer(size=100, maximum=150, target_seconds=1)
+        sizer.record(100, 0.5)
+        assert sizer.size == 125
+        sizer.record(100, 0.5)
+        sizer.record(150, 0.5)
+        assert sizer.size == 150
+        sizer.record(150, 3)
+        assert sizer.size == 50
+        # Small batches don't change the size
+        sizer.record(10, 3)
+        assert sizer.size == 50
+        sizer.shrink()
+        assert sizer.size == 25
+
+    def test_storage_write_workers(self, mock_request):
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         json=mock_datastore_search_03)
+
+        mock_datastore_upsert_fp = \
+            "tests/mock_responses/datastore_upsert.json"
+        mock_datastore_upsert = \
+            json.load(io.open(mock_datastore_upsert_fp, encoding='utf-8'))
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          json=mock_datastore_upsert)
+
+        articles_data = \
+            Stream('data/articles.csv', headers=1, encoding='utf-8').open()
+        self.storage.write('79843e49-7974-411c-8eb5-fb2d1111d707',
+                           articles_data, batch_size=1, workers=3)
+
+        history = mock_request.request_history[1:]
+        ids = [rec['id'] for r in history for rec in r.json()['records']]
+        assert sorted(ids) == ['1', '2', '3']
+
+
+    def test_storage_write_method(self, mock_request):
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          json={'success': True, 'result': {}})
+        articles_schema = \
+            json.load(io.open('data/articles.json', encoding='utf-8'))
+        rows = Stream('data/articles.csv', headers=1,
+                      encoding='utf-8').open().read()[:2]
+        keyless_schema = {k: v for k, v in articles_schema.items()
+                          if k not in ['primaryKey', 'foreignKeys']}
+
+        # Rows are upserted by primary key or inserted without one
+        self.storage.describe('articles', articles_schema)
+        self.storage.write('articles', rows)
+        self.storage.describe('events', keyless_schema)
+        self.storage.write('events', rows, calculate_record_count=True)
+        requests = [r.json() for r in mock_request.request_history]
+        assert [r['method'] for r in requests] == \
+            ['upsert', 'insert', 'insert']
+        assert 'calculate_record_count' not in requests[1]
+
+        # The record count is calculated once after the batches
+        assert requests[2]['calculate_record_count'] is True
+        assert requests[2]['records'] == []
+
+    def test_storage_write_method_remote(self, mock_request):
+        mock_datastore_search_fp_03 = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_03 = \
+            json.load(io.open(mock_datastore_search_fp_03, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         json=mock_datastore_search_03)
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          json={'success': True, 'result': {}})
+        rows = Stream('data/articles.csv', headers=1,
+                      encoding='utf-8').open().read()[:2]
+
+        # The primary key of a remote bucket isn't known, so rows are upserted
+        assert 'primaryKey' not in \
+            self.storage.describe('79843e49-7974-411c-8eb5-fb2d1111d707')
+        self.storage.write('79843e49-7974-411c-8eb5-fb2d1111d707', rows)
+        upsert = mock_request.request_history[-1]
+        assert upsert.json()['method'] == 'upsert'
+
+    @pytest.mark.parametrize('options', [{}, {'prefetch': 2}])
+    def test_storage_read_iter(self, mock_request, options):
 
         # Response gets the resource descriptors
         mock_datastore_search_describe_fp = \
@@ -373,5 +1160,386 @@ class TestStorage():
                 'created_time': None, 'created_datetime': None,
                 'stats': None, 'persons': None, 'location': None}]
 
-        assert self.storage.read('79843e49-7974-411c-8eb5-fb2d1111d707') == \
-            expected_data
+        assert self.storage.read('79843e49-7974-411c-8eb5-fb2d1111d707',
+                                 **options) == expected_data
+
+    @pytest.mark.parametrize('format', ['dict', 'numpy', 'arrow'])
+    def test_storage_iter_batches(self, mock_request, format):
+        if format != 'dict':
+            pytest.importorskip({'numpy': 'numpy', 'arrow': 'pyarrow'}[format])
+
+        # Response gets the resource descriptors
+        mock_datastore_search_describe_fp = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_describe = \
+            json.load(io.open(mock_datastore_search_describe_fp,
+                              encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',  # noqa
+                         json=mock_datastore_search_describe)
+
+        # Responses get the resource results two records at a time
+        mock_datastore_search_rows_fp = \
+            "tests/mock_responses/datastore_search_rows.json"
+        mock_datastore_search_rows = \
+            json.load(io.open(mock_datastore_search_rows_fp, encoding='utf-8'))
+        records = mock_datastore_search_rows['result']['records']
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search_sql',  # noqa
+                         [{'json': {'success': True,
+                                    'result': {'records': records[:2]}}},
+                          {'json': {'success': True,
+                                    'result': {'records': records[2:]}}}])
+
+        batches = list(self.storage.iter_batches(
+            '79843e49-7974-411c-8eb5-fb2d1111d707', batch_size=3,
+            format=format, paging='keyset', page_size=2,
+            fields=['id', 'rating', 'created_date']))
+        assert len(batches) == 1
+        columns = batches[0]
+        if format == 'arrow':
+            columns = columns.to_pydict()
+        assert list(columns['id']) == [1, 2, 3]
+        rating = list(columns['rating'])
+        if format == 'dict':
+            assert rating == [Decimal('9.5'), Decimal('7'), None]
+        elif format == 'numpy':
+            assert str(columns['rating'].dtype) == 'float64'
+            assert rating[:2] == [9.5, 7] and rating[2] != rating[2]
+        else:
+            assert rating == [9.5, 7, None]
+        if format == 'numpy':
+            assert str(columns['created_date'].dtype) == 'datetime64[D]'
+        else:
+            assert list(columns['created_date']) == \
+                [datetime.date(2015, 1, 1), datetime.date(2015, 12, 31), None]
+
+    def test_storage_read_columnar_empty(self, mock_request):
+        mock_datastore_search_describe_fp = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_describe = \
+            json.load(io.open(mock_datastore_search_describe_fp,
+                              encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',  # noqa
+                         json=mock_datastore_search_describe)
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search_sql',  # noqa
+                         json={'success': True, 'result': {'records': []}})
+
+        columns = self.storage.read_columnar(
+            '79843e49-7974-411c-8eb5-fb2d1111d707', paging='keyset',
+            fields=['id', 'name'])
+        assert columns == {'id': [], 'name': []}
+        with pytest.raises(tableschema.exceptions.StorageError):
+            self.storage.read_columnar(
+                '79843e49-7974-411c-8eb5-fb2d1111d707', format='pandas')
+
+    def test_storage_read_iter_keyset(self, mock_request):
+
+        # Response gets the resource descriptors
+        mock_datastore_search_describe_fp = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_describe = \
+            json.load(io.open(mock_datastore_search_describe_fp,
+                              encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',  # noqa
+                         json=mock_datastore_search_describe)
+
+        # Responses get the resource results two records at a time
+        mock_datastore_search_rows_fp = \
+            "tests/mock_responses/datastore_search_rows.json"
+        mock_datastore_search_rows = \
+            json.load(io.open(mock_datastore_search_rows_fp, encoding='utf-8'))
+        records = mock_datastore_search_rows['result']['records']
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search_sql',  # noqa
+                         [{'json': {'success': True,
+                                    'result': {'records': records[:2]}}},
+                          {'json': {'success': True,
+                                    'result': {'records': records[2:]}}}])
+
+        rows = self.storage.read('79843e49-7974-411c-8eb5-fb2d1111d707',
+                                 paging='keyset', page_size=2)
+        assert [row['id'] for row in rows] == [1, 2, 3]
+
+        history = mock_request.request_history
+        sql = [r.qs['sql'][0] for r in history[1:]]
+        assert len(sql) == 2
+        assert sql[0].endswith(
+            'from "79843e49-7974-411c-8eb5-fb2d1111d707" '
+            'order by "_id" limit 2')
+        assert 'where ("_id") > (2)' in sql[1]
+
+    @pytest.mark.parametrize('paging', ['offset', 'keyset'])
+    def test_storage_read_iter_stream(self, mock_request, paging):
+
+        # Response gets the resource descriptors
+        mock_datastore_search_describe_fp = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_describe = \
+            json.load(io.open(mock_datastore_search_describe_fp,
+                              encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',  # noqa
+                         json=mock_datastore_search_describe)
+
+        # Responses get the resource results two records at a time
+        mock_datastore_search_rows_fp = \
+            "tests/mock_responses/datastore_search_rows.json"
+        mock_datastore_search_rows = \
+            json.load(io.open(mock_datastore_search_rows_fp, encoding='utf-8'))
+        records = mock_datastore_search_rows['result']['records']
+        pages = [{'json': {'success': True,
+                           'result': {'records': records[:2]}}},
+                 {'json': {'success': True,
+                           'result': {'records': records[2:]}}},
+                 {'json': {'success': True, 'result': {'records': []}}}]
+        if paging == 'offset':
+            for offset, page in zip([0, 2, 3], pages):
+                mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?offset={}'.format(offset),  # noqa
+                                 [page])
+        else:
+            mock_request.get('https://demo.ckan.org/api/3/action/datastore_search_sql',  # noqa
+                             pages)
+
+        rows = self.storage.read('79843e49-7974-411c-8eb5-fb2d1111d707',
+                                 paging=paging, page_size=2, stream=True)
+        assert [row['id'] for row in rows] == [1, 2, 3]
+        assert rows[0]['rating'] == Decimal('9.5')
+        assert rows[0]['stats'] == {'chars': 560, 'height': 54.8}
+
+    @pytest.mark.parametrize('stream', [False, True])
+    def test_storage_compress(self, mock_request, stream):
+        storage = Storage(base_url='https://demo.ckan.org/', compress=True)
+        mock_datastore_search_describe_fp = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_describe = \
+            json.load(io.open(mock_datastore_search_describe_fp,
+                              encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?limit=0',  # noqa
+                         json=mock_datastore_search_describe)
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          json={'success': True, 'result': {}})
+
+        # Large request bodies are gzipped
+        rows = Stream('data/articles.csv', headers=1,
+                      encoding='utf-8').open().read()[:2]
+        storage.write('79843e49-7974-411c-8eb5-fb2d1111d707', rows * 10,
+                      batch_size=10)
+        requests = mock_request.request_history[1:]
+        assert requests[0].headers['Content-Encoding'] == 'gzip'
+        assert len(json.loads(zlib.decompress(
+            requests[0].body, 16 + zlib.MAX_WBITS).decode('utf-8'))['records']) == 10
+
+        # Gzipped responses are decoded, as they are read if streamed
+        mock_datastore_search_rows_fp = \
+            "tests/mock_responses/datastore_search_rows.json"
+        mock_datastore_search_rows = \
+            json.load(io.open(mock_datastore_search_rows_fp, encoding='utf-8'))
+        pages = [mock_datastore_search_rows['result']['records'], []]
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         [{'content': gzip_content(json.dumps({
+                             'success': True,
+                             'result': {'records': records,
+                                        '_links': {'next': '/next'}}
+                         }).encode('utf-8')),
+                           'headers': {'Content-Encoding': 'gzip'}}
+                          for records in pages])
+        mock_request.get('https://demo.ckan.org/next',
+                         json={'success': True, 'result': {'records': []}})
+        rows = storage.read('79843e49-7974-411c-8eb5-fb2d1111d707',
+                            stream=stream)
+        assert [row['id'] for row in rows] == [1, 2, 3]
+
+    def test_storage_read_iter_dump(self, mock_request):
+
+        # Response gets the resource descriptors
+        mock_datastore_search_describe_fp = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_describe = \
+            json.load(io.open(mock_datastore_search_describe_fp,
+                              encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',  # noqa
+                         json=mock_datastore_search_describe)
+
+        # Response streams the resource as CSV
+        dump = (
+            '_id,id,parent,name,current,rating,created_year,created_date,'
+            'created_time,created_datetime,stats,persons,location\r\n'
+            '1,1,,"Taxes,\r\nfees",true,9.5,2015,2015-01-01,03:00:00,'
+            '2015-01-01T03:00:00,"{""chars"": 560}","[""mike"", ""alice""]",'
+            '"{""type"": ""Point"", ""coordinates"": [50.0, 50.0]}"\r\n'
+            '2,2,1,中国人,false,7,,,,,,,\r\n')
+        mock_request.get('https://demo.ckan.org/datastore/dump/79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         content=dump.encode('utf-8'))
+
+        rows = self.storage.read('79843e49-7974-411c-8eb5-fb2d1111d707',
+                                 paging='dump', page_size=1)
+        assert rows[0]['name'] == 'Taxes,\r\nfees'
+        assert rows[0]['parent'] is None
+        assert rows[0]['current'] is True
+        assert rows[0]['rating'] == Decimal('9.5')
+        assert rows[0]['created_datetime'] == \
+            datetime.datetime(2015, 1, 1, 3, 0)
+        assert rows[0]['stats'] == {'chars': 560}
+        assert rows[0]['persons'] == ['mike', 'alice']
+        assert rows[1]['name'] == '中国人'
+        assert rows[1]['created_date'] is None
+        assert rows[1]['stats'] is None
+        assert len(rows) == 2
+
+        history = mock_request.request_history
+        assert history[1].qs == {'format': ['csv']}
+
+    def test_storage_iter_prefetch_error(self, mock_request):
+
+        # Response gets the resource descriptors
+        mock_datastore_search_describe_fp = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_describe = \
+            json.load(io.open(mock_datastore_search_describe_fp,
+                              encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707&limit=0',  # noqa
+                         json=mock_datastore_search_describe)
+
+        # First page succeeds and the next one fails
+        mock_datastore_search_rows_fp = \
+            "tests/mock_responses/datastore_search_rows.json"
+        mock_datastore_search_rows = \
+            json.load(io.open(mock_datastore_search_rows_fp, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         json=mock_datastore_search_rows, complete_qs=True)
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707&offset=100',  # noqa
+                         json={'success': False, 'error': {'message': 'Failed'}},
+                         complete_qs=True)
+
+        rows = self.storage.iter('79843e49-7974-411c-8eb5-fb2d1111d707',
+                                 prefetch=1)
+        assert next(rows)['id'] == 1
+        with pytest.raises(tableschema.exceptions.StorageError):
+            list(rows)
+
+    def test_storage_read_query(self, mock_request):
+
+        # Response gets the resource descriptors
+        mock_datastore_search_describe_fp = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_describe = \
+            json.load(io.open(mock_datastore_search_describe_fp,
+                              encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707&limit=0',  # noqa
+                         json=mock_datastore_search_describe, complete_qs=True)
+
+        # Response gets the projected resource results
+        mock_datastore_search_rows_fp = \
+            "tests/mock_responses/datastore_search_rows.json"
+        mock_datastore_search_rows = \
+            json.load(io.open(mock_datastore_search_rows_fp, encoding='utf-8'))
+        for record in mock_datastore_search_rows['result']['records']:
+            for name in list(record):
+                if name not in ['name', 'created_datetime']:
+                    del record[name]
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',  # noqa
+                         json=mock_datastore_search_rows)
+
+        rows = self.storage.read('79843e49-7974-411c-8eb5-fb2d1111d707',
+                                 fields=['name', 'created_datetime'],
+                                 filters={'current': True, 'parent': [1, 2]},
+                                 q='taxes', sort='name desc', limit=2)
+        assert rows == [
+            {'name': 'Taxes',
+             'created_datetime': datetime.datetime(2015, 1, 1, 3, 0)},
+            {'name': '中国人',
+             'created_datetime': datetime.datetime(2015, 12, 31, 15, 45, 33)},
+        ]
+
+        # Only one page was requested
+        history = mock_request.request_history
+        assert len(history) == 2
+        assert history[1].qs == {
+            'resource_id': ['79843e49-7974-411c-8eb5-fb2d1111d707'],
+            'fields': ['name,created_datetime'],
+            'filters': ['{"current": true, "parent": [1, 2]}'],
+            'q': ['taxes'],
+            'sort': ['name desc'],
+            'limit': ['2'],
+        }
+
+    def test_storage_read_query_keyset(self, mock_request):
+
+        # Response gets the resource descriptors
+        mock_datastore_search_describe_fp = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_describe = \
+            json.load(io.open(mock_datastore_search_describe_fp,
+                              encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search',  # noqa
+                         json=mock_datastore_search_describe)
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search_sql',  # noqa
+                         json={'success': True,
+                               'result': {'records': [{'_id': 1, 'id': 1}]}})
+
+        rows = self.storage.read('79843e49-7974-411c-8eb5-fb2d1111d707',
+                                 paging='keyset', fields=['id'],
+                                 filters={'name': ["O'Neil", 'Taxes']})
+        assert rows == [{'id': 1}]
+        sql = mock_request.request_history[1].qs['sql'][0]
+        assert sql == ('select "_id", "id" '
+                       'from "79843e49-7974-411c-8eb5-fb2d1111d707" '
+                       'where "name" in (\'o\'\'neil\', \'taxes\') '
+                       'order by "_id" limit 100')
+
+        with pytest.raises(tableschema.exceptions.StorageError):
+            self.storage.read('79843e49-7974-411c-8eb5-fb2d1111d707',
+                              paging='keyset', sort='name')
+
+    def test_storage_metrics(self, mock_request):
+        metrics = InMemoryMetrics()
+        storage = Storage(base_url='https://demo.ckan.org/', metrics=metrics)
+
+        mock_datastore_search_describe_fp = \
+            "tests/mock_responses/datastore_search_describe.json"
+        mock_datastore_search_describe = \
+            json.load(io.open(mock_datastore_search_describe_fp,
+                              encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707&limit=0',  # noqa
+                         json=mock_datastore_search_describe)
+        mock_datastore_search_rows_fp = \
+            "tests/mock_responses/datastore_search_rows.json"
+        mock_datastore_search_rows = \
+            json.load(io.open(mock_datastore_search_rows_fp, encoding='utf-8'))
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707',  # noqa
+                         json=mock_datastore_search_rows, complete_qs=True)
+        mock_request.get('https://demo.ckan.org/api/3/action/datastore_search?resource_id=79843e49-7974-411c-8eb5-fb2d1111d707&offset=100',  # noqa
+                         json={'success': False, 'error': {'message': 'X'}},
+                         complete_qs=True)
+        mock_request.post('https://demo.ckan.org/api/3/action/datastore_upsert',  # noqa
+                          json={'success': True, 'result': {}})
+
+        with pytest.raises(tableschema.exceptions.StorageError):
+            storage.read('79843e49-7974-411c-8eb5-fb2d1111d707')
+        articles_data = \
+            Stream('data/articles.csv', headers=1, encoding='utf-8').open()
+        storage.write('79843e49-7974-411c-8eb5-fb2d1111d707', articles_data,
+                      batch_size=2)
+
+        summary = metrics.summary()
+        search = summary['requests']['datastore_search']
+        assert search['count'] == 3
+        assert search['errors'] == 1
+        assert search['bytes_received'] > 0
+        upsert = summary['requests']['datastore_upsert']
+        assert upsert['count'] == 2
+        assert upsert['bytes_sent'] > 0
+        assert summary['phases']['restore']['rows'] == 3
+        assert summary['phases']['fetch']['count'] == 1
+        assert summary['phases']['convert']['rows'] == 3
+        assert summary['phases']['send']['rows'] == 3
+        assert 'ckan_datastore_requests_count{action="datastore_upsert"} 2' \
+            in metrics.render_prometheus().splitlines()
+
+    def test_storage_metrics_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        metrics = StatsdMetrics(*server.getsockname(), prefix='test')
+        metrics.on_phase('convert', 'bucket', 0.5, 10)
+        lines = server.recv(1024).decode('utf-8').splitlines()
+        server.close()
+        assert lines == ['test.phase.convert.time:500.000|ms',
+                         'test.phase.convert.rows:10|c']